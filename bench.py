@@ -0,0 +1,547 @@
+"""Benchmarks for the slow parts of the script.
+
+Usage: python bench.py <benchmark> [args]
+"""
+import argparse
+import json
+import random
+import tempfile
+import timeit
+import zipfile
+from pathlib import Path
+
+SAMPLE_ERP_PAGES = [str(Path(__file__).parent / 'samples' / name)
+                    for name in ('erp-weekly-sched.html', 'erp-sched-form.html')]
+
+
+def report(name, func, number):
+    total = min(timeit.repeat(func, number=number, repeat=3))
+    print(f"{name:<30} {total / number * 1000:10.2f} ms")
+    return total
+
+
+def bench_erp_parse(args):
+    """Parse saved ERP pages with the full and the targeted parsers"""
+    from bs4 import BeautifulSoup
+
+    import erp
+
+    print("Fast parser backend:", erp.FAST_PARSER)
+    for path in args.pages:
+        with open(path, encoding='utf-8', errors='replace') as f:
+            html = f.read()
+        print(f"{path} ({len(html) // 1024} KiB)")
+        is_sched = erp.SCHED_TABLE_ID in html
+        name, id_ = ('table', erp.SCHED_TABLE_ID) if is_sched else ('form', None)
+        extract = erp.get_sched_rows if is_sched else erp.get_form_fields
+
+        def full():
+            return extract(BeautifulSoup(html, 'html.parser').find(name, id=id_))
+
+        def fast():
+            return extract(erp.find_element(html, name, id_))
+
+        assert full() == fast(), "Parsed data differs"
+        slow = report("full html.parser", full, args.number)
+        quick = report("targeted", fast, args.number)
+        print(f"{'speedup':<30} {slow / quick:10.2f}x")
+
+
+def make_workbook(path, num_courses, rows_per_sheet=500):
+    """Write a synthetic timetable workbook in the format of the TD one.
+
+    Like the real one, the sheets have a fixed number of rows, so courses are
+    split between sheets at different rows. Returns the number of such courses.
+    """
+    from openpyxl import Workbook
+
+    rand = random.Random(0)
+    days = ('M', 'T', 'W', 'Th', 'F', 'S')
+    rows, course_starts = [], []
+    for num in range(num_courses):
+        course_starts.append(len(rows))
+        rows.append([
+            num, f"CS F{num:03}", f"SYNTHETIC COURSE {num}", 3, 0, 3, 1,
+            "INSTRUCTOR A", " ".join(rand.sample(days, 3)), str(rand.randint(1, 9)),
+            f"{rand.randint(1, 28):02}/03 \n11.00 - 12.30PM",
+            f"{rand.randint(1, 28):02}/05 {rand.choice(('FN', 'AN'))}",
+        ])
+        rows.append([None] * 7 + ["INSTRUCTOR B"])
+        for sec_type, count in (("Tutorial", 2), ("Practical", 3)):
+            for sec in range(count):
+                rows.append([
+                    None, None, sec_type if sec == 0 else None, None, None, None,
+                    sec + 1, f"INSTRUCTOR {sec_type[0]}{sec}",
+                    rand.choice(days), f"{rand.randint(1, 4)} {rand.randint(6, 9)}",
+                ])
+
+    workbook = Workbook(write_only=True)
+    for start in range(0, len(rows), rows_per_sheet):
+        sheet = workbook.create_sheet(f"Page {start // rows_per_sheet + 1}")
+        for row in [
+            ["COM COD", "COURSE NO.", "COURSE TITLE", "CREDIT"],
+            ["", "", "", "L", "P", "U", "SEC", "INSTRUCTOR", "DAYS", "HOURS"],
+            *rows[start:start + rows_per_sheet],
+        ]:
+            sheet.append(row + [""] * (12 - len(row)))  # rows are of full width
+    workbook.save(path)
+    course_ends = course_starts[1:] + [len(rows)]
+    return sum(start // rows_per_sheet != (end - 1) // rows_per_sheet
+               for start, end in zip(course_starts, course_ends))
+
+
+def legacy_iter_rows(path, column_map):
+    """The original cell based version of parse_excel.iter_rows"""
+    from openpyxl import load_workbook
+
+    for sheet in load_workbook(path, read_only=True):
+        rows = sheet.rows
+        next(rows)
+        next(rows)
+        for row in rows:
+            if not row:
+                continue
+            yield {name: row[col].value for name, col in column_map.items()}
+
+
+def bench_excel(args):
+    """Parse a large synthetic timetable workbook"""
+    import parse_excel
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / "timetable.xlsx"
+        num_split = make_workbook(path, args.courses)
+        columns = {"c_num": 1, "c_title": 2, "sec_num": 6, "instr_name": 7,
+                   "days": 8, "hours": 9, "midsem": 10, "compre": 11}
+
+        def read_rows(iter_rows):
+            return list(iter_rows(path, columns))
+
+        assert read_rows(legacy_iter_rows) == read_rows(parse_excel.iter_rows)
+        print(f"{args.courses} courses, {num_split} of them split between sheets")
+        slow = report("openpyxl cell rows", lambda: read_rows(legacy_iter_rows),
+                      args.number)
+        quick = report("streamed xml rows", lambda: read_rows(parse_excel.iter_rows),
+                       args.number)
+        print(f"{'speedup':<30} {slow / quick:10.2f}x")
+        serial = parse_excel.parse_main_tt(path)
+        parallel = parse_excel.parse_main_tt_parallel(path, args.workers)
+        assert json.dumps(serial) == json.dumps(parallel), "Parallel parse differs"
+        slow = report("parse_main_tt", lambda: parse_excel.parse_main_tt(path),
+                      args.number)
+        quick = report(
+            f"parse_main_tt_parallel (-j {args.workers})",
+            lambda: parse_excel.parse_main_tt_parallel(path, args.workers),
+            args.number)
+        print(f"{'speedup':<30} {slow / quick:10.2f}x")
+
+        def open_workbook():
+            with zipfile.ZipFile(path) as xlsx:
+                parse_excel.read_shared_strings(xlsx)
+                parse_excel.get_sheet_paths(xlsx)
+
+        # paid once by each worker of parse_main_tt_parallel
+        print(f"{parse_excel.count_sheets(path)} sheets")
+        report("open workbook, shared strings", open_workbook, args.number)
+
+
+def bench_coursedb(args):
+    """Load the parsed timetable from the JSON and the binary caches"""
+    import pickle
+
+    import parse_excel
+    from models import Course
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        make_workbook(tmp_dir / "timetable.xlsx", args.courses)
+        timetable = parse_excel.parse_main_tt(tmp_dir / "timetable.xlsx")
+        json_file = tmp_dir / "bench-timetable.json"
+        pickle_file = tmp_dir / "bench-timetable.pickle"
+        with open(json_file, 'w') as f:
+            json.dump(timetable, f, indent=4)
+        with open(pickle_file, 'wb') as f:
+            pickle.dump(timetable, f, pickle.HIGHEST_PROTOCOL)
+
+        def load_json():
+            with open(json_file) as f:
+                return json.load(f)
+
+        def load_pickle():
+            with open(pickle_file, 'rb') as f:
+                return pickle.load(f)
+
+        print(f"{args.courses} courses, JSON {json_file.stat().st_size // 1024} KiB, "
+              f"binary {pickle_file.stat().st_size // 1024} KiB")
+        slow = report("json", load_json, args.number)
+        quick = report("binary", load_pickle, args.number)
+        print(f"{'speedup':<30} {slow / quick:10.2f}x")
+
+        db = parse_excel.CourseDB()
+        db.tt_file, db.midsem_file = json_file, tmp_dir / "missing.xlsx"
+        db.load()  # writes the indexed cache
+        codes = list(timetable)[:10]
+
+        def load_courses():
+            db.load()
+            return [db[code] for code in codes]
+
+        from_json = load_json()
+        assert load_courses() == [Course.from_dict(code, from_json[code])
+                                  for code in codes]
+        report(f"indexed, {len(codes)} courses", load_courses, args.number)
+        report("indexed, all courses", lambda: db.load() or db.timetable, args.number)
+
+
+def bench_memory(args):
+    """Memory used by the timetable as dicts and as the models"""
+    import pickle
+    import tracemalloc
+
+    import parse_excel
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / "timetable.xlsx"
+        make_workbook(path, args.courses)
+        timetable = parse_excel.parse_main_tt(path)
+    as_dicts = pickle.dumps(timetable, pickle.HIGHEST_PROTOCOL)
+    as_models = pickle.dumps(parse_excel.to_models(timetable), pickle.HIGHEST_PROTOCOL)
+
+    def measure(name, data):
+        tracemalloc.start()
+        loaded = pickle.loads(data)
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del loaded
+        print(f"{name:<30} {size / 1024:10.0f} KiB")
+        return size
+
+    print(f"{args.courses} courses")
+    large = measure("dicts", as_dicts)
+    small = measure("models", as_models)
+    print(f"{'reduction':<30} {large / small:10.2f}x")
+    report("load dicts", lambda: pickle.loads(as_dicts), args.number)
+    report("load models", lambda: pickle.loads(as_models), args.number)
+
+
+def bench_events(args):
+    """Generate the events of all the sections of a synthetic timetable"""
+    import parse_excel
+    from events import make_course_events
+    from timetable import get_course
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        make_workbook(tmp_dir / "timetable.xlsx", args.courses)
+        db = parse_excel.course_db
+        db.tt_file, db.midsem_file = tmp_dir / "timetable.xlsx", tmp_dir / "missing"
+        db.load()
+        courses = [get_course(code, sorted(db[code].sections)) for code in db.codes()]
+
+        def make_events():
+            return [event for course in courses for event in make_course_events(course)]
+
+        print(f"{args.courses} courses, {len(make_events())} events")
+        report("make_course_events", make_events, args.number)
+
+
+def bench_server(args):
+    """Request the timetables of random students from the service concurrently"""
+    import asyncio
+    import statistics
+    import time
+
+    import aiohttp
+    from aiohttp import web
+
+    import parse_excel
+    from server import TimetableService, make_app
+
+    async def run(app, students):
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        latencies = []
+        semaphore = asyncio.Semaphore(args.concurrency)
+
+        async def request(session, sections):
+            url = f'http://127.0.0.1:{port}/timetable.{args.format}'
+            async with semaphore:
+                headers, status = {}, 200
+                if args.revalidate:
+                    async with session.post(url, json={'sections': sections}) as resp:
+                        headers['If-None-Match'] = resp.headers['ETag']
+                        status = 304
+                start = time.perf_counter()
+                async with session.post(url, json={'sections': sections},
+                                        headers=headers) as resp:
+                    assert resp.status == status, await resp.text()
+                    await resp.read()
+                latencies.append(time.perf_counter() - start)
+
+        async with aiohttp.ClientSession() as session:
+            start = time.perf_counter()
+            await asyncio.gather(*(request(session, sections) for sections in students))
+            elapsed = time.perf_counter() - start
+        await runner.cleanup()
+        return latencies, elapsed
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        tmp_dir = Path(tmp_dir)
+        make_workbook(tmp_dir / "timetable.xlsx", args.courses)
+        db = parse_excel.course_db
+        db.tt_file, db.midsem_file = tmp_dir / "timetable.xlsx", tmp_dir / "missing"
+        start = time.perf_counter()
+        app = make_app(TimetableService())
+        print(f"{'startup (load caches)':<30} {(time.perf_counter() - start) * 1000:10.2f} ms")
+
+        rand = random.Random(0)
+        codes = sorted(db.codes())
+        students = [
+            {code: ['L1', f'T{rand.randint(1, 2)}', f'P{rand.randint(1, 3)}']
+             for code in rand.sample(codes, 6)}
+            for _ in range(args.requests)
+        ]
+        latencies, elapsed = asyncio.run(run(app, students))
+
+    latencies.sort()
+    print(f"{args.requests} requests, {args.concurrency} at once, {args.format}"
+          + (", revalidated" if args.revalidate else ""))
+    for name, value in (
+            ("mean", statistics.mean(latencies)),
+            ("p50", latencies[len(latencies) // 2]),
+            ("p99", latencies[int(len(latencies) * 0.99)])):
+        print(f"{name:<30} {value * 1000:10.2f} ms")
+    print(f"{'throughput':<30} {args.requests / elapsed:10.0f} req/s")
+
+
+def bench_gcal_quota(args):
+    """Create events on a local fake Calendar API, which throttles like Google's"""
+    import email
+    import threading
+    import time
+    from concurrent.futures import ThreadPoolExecutor
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    import httplib2
+    from googleapiclient.http import BatchHttpRequest, HttpRequest
+
+    from quota import RequestScheduler, TokenBucket
+
+    server_bucket = TokenBucket(args.server_rate, args.server_rate)
+    rejected = 0
+    lock = threading.Lock()
+
+    def respond(body):
+        """Status, headers and body of the response to a request to the fake API"""
+        nonlocal rejected
+        if server_bucket.reserve() > 0:
+            server_bucket.reserve(-1)  # give back the token, it wasn't used
+            with lock:
+                rejected += 1
+            if rejected % 2:
+                error = {'code': 429, 'errors': [{'reason': 'rateLimitExceeded'}]}
+                return 429, {'Retry-After': '1'}, {'error': error}
+            error = {'code': 403, 'errors': [{'reason': 'userRateLimitExceeded'}]}
+            return 403, {}, {'error': error}
+        event = json.loads(body or '{}')
+        event['id'] = f'{random.getrandbits(64):x}'
+        return 200, {}, event
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *_):
+            pass
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers['Content-Length']))
+            if self.path != '/batch':
+                status, headers, data = respond(body)
+                self.send(status, 'application/json', json.dumps(data).encode(),
+                          headers)
+                return
+            content_type = self.headers['Content-Type']
+            message = email.message_from_bytes(
+                f'Content-Type: {content_type}\r\n\r\n'.encode() + body)
+            boundary = 'fake-batch-response'
+            parts = []
+            for part in message.get_payload():
+                request = part.get_payload()
+                _, _, request_body = request.partition('\r\n\r\n')
+                if not request_body:
+                    _, _, request_body = request.partition('\n\n')
+                status, headers, data = respond(request_body)
+                content_id = part['Content-ID'].replace('<', '<response-', 1)
+                lines = [f'HTTP/1.1 {status} OK', 'Content-Type: application/json',
+                         *(f'{name}: {value}' for name, value in headers.items()),
+                         '', json.dumps(data)]
+                parts.append(f'--{boundary}\r\nContent-Type: application/http\r\n'
+                             f'Content-ID: {content_id}\r\n\r\n'
+                             + '\r\n'.join(lines) + '\r\n')
+            payload = ''.join(parts) + f'--{boundary}--\r\n'
+            self.send(200, f'multipart/mixed; boundary={boundary}', payload.encode())
+
+        def send(self, status, content_type, payload, headers=None):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(payload)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f'http://127.0.0.1:{server.server_port}'
+    scheduler = RequestScheduler(args.rate, args.rate, args.max_concurrency)
+    local = threading.local()
+
+    def get_http():
+        if not hasattr(local, 'http'):
+            local.http = httplib2.Http()
+        return local.http
+
+    def make_request(num):
+        return HttpRequest(
+            get_http(), lambda resp, content: json.loads(content),
+            f'{base}/calendar/v3/calendars/primary/events', method='POST',
+            body=json.dumps({'summary': f'Event {num}'}),
+            headers={'content-type': 'application/json'})
+
+    def create(num):
+        return scheduler.execute(make_request(num), http=get_http())
+
+    def create_batch(nums):
+        return scheduler.execute_batch(
+            lambda callback: BatchHttpRequest(callback, batch_uri=f'{base}/batch'),
+            ((str(num), make_request(num)) for num in nums), http=get_http())
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.max_concurrency * 2) as executor:
+        if args.batch:
+            chunks = [range(num, min(num + args.batch, args.requests))
+                      for num in range(0, args.requests, args.batch)]
+            results = list(executor.map(create_batch, chunks))
+            created = sum(len(responses) for responses, _ in results)
+        else:
+            created = len(list(executor.map(create, range(args.requests))))
+    elapsed = time.perf_counter() - start
+    server.shutdown()
+
+    print(f"{args.requests} events, {args.rate:g} req/s against {args.server_rate:g} req/s"
+          + (f", in batches of {args.batch}" if args.batch else ""))
+    print(f"{'created':<30} {created:10}")
+    print(f"{'rejected by the server':<30} {rejected:10}")
+    print(f"{'elapsed':<30} {elapsed:10.2f} s")
+    print(f"{'throughput':<30} {created / elapsed:10.1f} events/s")
+    print("metrics:", scheduler.metrics)
+
+
+def bench_startup(args):
+    """Time the imports of the entry points, and building the Calendar service"""
+    import subprocess
+    import sys
+
+    google_libs = ('gcal', 'googleapiclient', 'oauth2client', 'httplib2')
+    for module in args.modules:
+        code = (f'import sys, {module}; '
+                f'print(any(name.split(".")[0] in {google_libs} for name in sys.modules))')
+
+        def run():
+            return subprocess.run([sys.executable, '-c', code], check=True,
+                                  capture_output=True, text=True).stdout.strip()
+
+        uses_google = run() == 'True'
+        report(f"import {module}" + (" (+google)" if uses_google else ""),
+               run, args.number)
+
+    import httplib2
+    from apiclient.discovery import build, build_from_document
+
+    import gcal
+
+    try:
+        doc = gcal.get_discovery_doc()
+    except (httplib2.HttpLib2Error, OSError, gcal.HttpError) as e:
+        print(f"No cached discovery document, and failed to fetch it: {e}")
+        return
+    report("build_from_document", lambda: build_from_document(
+        doc, http=httplib2.Http()), args.number)
+    if args.online:
+        report("build (fetches the doc)", lambda: build(
+            'calendar', 'v3', http=httplib2.Http(), cache_discovery=False), args.number)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--number', type=int, default=10,
+                        help="Number of runs per measurement")
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    erp_parse = subparsers.add_parser('erp-parse', help=bench_erp_parse.__doc__)
+    erp_parse.add_argument('pages', nargs='*', default=SAMPLE_ERP_PAGES,
+                           help="Saved HTML of the ERP weekly schedule pages "
+                                "(default: the synthetic pages in samples/)")
+    erp_parse.set_defaults(func=bench_erp_parse)
+
+    excel = subparsers.add_parser('excel', help=bench_excel.__doc__)
+    excel.add_argument('-c', '--courses', type=int, default=2000,
+                       help="Number of courses in the workbook")
+    excel.add_argument('-j', '--workers', type=int, default=None,
+                       help="Number of processes for the parallel parser")
+    excel.set_defaults(func=bench_excel)
+
+    coursedb = subparsers.add_parser('coursedb', help=bench_coursedb.__doc__)
+    coursedb.add_argument('-c', '--courses', type=int, default=2000,
+                          help="Number of courses in the timetable")
+    coursedb.set_defaults(func=bench_coursedb)
+
+    memory = subparsers.add_parser('memory', help=bench_memory.__doc__)
+    memory.add_argument('-c', '--courses', type=int, default=2000,
+                        help="Number of courses in the timetable")
+    memory.set_defaults(func=bench_memory)
+
+    events = subparsers.add_parser('events', help=bench_events.__doc__)
+    events.add_argument('-c', '--courses', type=int, default=2000,
+                        help="Number of courses in the timetable")
+    events.set_defaults(func=bench_events)
+
+    server = subparsers.add_parser('server', help=bench_server.__doc__)
+    server.add_argument('-c', '--courses', type=int, default=2000,
+                        help="Number of courses in the timetable")
+    server.add_argument('-r', '--requests', type=int, default=1000,
+                        help="Number of requests")
+    server.add_argument('--concurrency', type=int, default=50,
+                        help="Number of requests at once")
+    server.add_argument('--format', choices=('json', 'ics'), default='json')
+    server.add_argument('--revalidate', action='store_true', default=False,
+                        help="Time the requests with the ETag of the previous response")
+    server.set_defaults(func=bench_server)
+
+    gcal_quota = subparsers.add_parser('gcal-quota', help=bench_gcal_quota.__doc__)
+    gcal_quota.add_argument('-r', '--requests', type=int, default=300,
+                            help="Number of events to create")
+    gcal_quota.add_argument('--rate', type=float, default=50,
+                            help="Requests per second allowed by the scheduler")
+    gcal_quota.add_argument('--server-rate', type=float, default=40,
+                            help="Requests per second allowed by the fake API")
+    gcal_quota.add_argument('--max-concurrency', type=int, default=4,
+                            help="Number of requests in flight")
+    gcal_quota.add_argument('--batch', type=int, default=0,
+                            help="Send the requests in batches of this size")
+    gcal_quota.set_defaults(func=bench_gcal_quota)
+
+    startup = subparsers.add_parser('startup', help=bench_startup.__doc__)
+    startup.add_argument('modules', nargs='*', default=['main', 'bulk', 'gcal'],
+                         help="Modules to time the import of, in a new process")
+    startup.add_argument('--online', action='store_true', default=False,
+                         help="Also time building the service with the fetched doc")
+    startup.set_defaults(func=bench_startup)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,234 @@
+"""Create the calendars for a whole roster of students in one go.
+
+The roster is a TOML file with a `[[student]]` table for each student:
+
+    [[student]]
+    name = "Some Student"  # optional, used in the report
+    google_creds = "creds/some-student.json"  # stored Google credentials
+    wstoken = "368b0c8b11dce69420ca42ef45bdd1dc"  # Moodle key, or no CMS
+    overrides = {"IS F341" = {"L2" = "L1"}}  # optional
+
+    [student.erp]
+    username = "42020170069"
+    password = "password"
+
+The timetable, the academic calendar and the generated events are shared by
+all the workers.
+
+With --only-affected, only the calendars of the students affected by the
+changes since the previous revision of the timetable are synced.
+With --sink ics, the events of each student are written to an .ics file named
+after their ERP username instead, and `google_creds` isn't needed.
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import reduce
+from operator import ior
+
+from cms import MAX_CONCURRENCY as CMS_CONCURRENCY
+from cms import CMSClient, CourseResolver, make_session
+from erp import MAX_CONCURRENCY, ERPPool
+from events import EventType
+from ics import write_calendar
+from main import (create_events, enrol_cms, get_cal_name, override_sections,
+                  parse_args, set_cal, sync_events)
+from parse_excel import course_db
+from revisions import diff_timetables, get_affected_events
+from templates import EventTemplates
+from utils import read_toml
+
+STAGES = ('erp', 'cms', 'gcal', 'ics')
+
+
+def get_student_name(student):
+    return student.get('name') or student['erp']['username']
+
+
+def process_student(student, report, gcal, templates, erp_pool, resolver, args):
+    timings = report['timings']
+
+    start = time.perf_counter()
+    sections, _ = erp_pool.get_reg_sections(student['erp'], args.max_age)
+    sections = override_sections(sections, student.get('overrides', {}))
+    timings['erp'] = time.perf_counter() - start
+
+    if not args.skip_cms and not student.get('wstoken'):
+        report['notes'].append('no wstoken')  # never enrol with the config's token
+    elif not args.skip_cms:
+        start = time.perf_counter()
+        client = CMSClient(student['wstoken'], resolver.client.session)
+        enrol_cms(sections, client, resolver)
+        timings['cms'] = time.perf_counter() - start
+
+    if gcal and args.revision:
+        old, changes = args.revision
+        keys = get_affected_events(changes, sections, old, course_db.timetable)
+        if not keys:
+            print("No changes in the timetable of", get_student_name(student))
+            gcal = None
+        else:
+            print(f"{len(keys)} events of {get_student_name(student)} are affected.")
+
+    if gcal:
+        start = time.perf_counter()
+        set_cal(gcal, args.title, not args.sync)
+        events = [event
+                  for course_code, course_sections in sections.items()
+                  for event in templates.get(course_code, course_sections)]
+        if args.sync:
+            sync_events(gcal, events)
+        else:
+            create_events(gcal, events)
+        timings['gcal'] = time.perf_counter() - start
+
+    if args.sink == 'ics' and not args.only_cms:
+        start = time.perf_counter()
+        events = (event
+                  for course_code, course_sections in sections.items()
+                  for event in templates.get(course_code, course_sections))
+        ics_file = os.path.join(args.ics_dir, student['erp']['username'] + '.ics')
+        write_calendar(ics_file, events, args.title)
+        timings['ics'] = time.perf_counter() - start
+
+
+def run_student(student, gcal, templates, erp_pool, resolver, args):
+    """Process the student and return a report of the run"""
+    report = {'name': get_student_name(student), 'status': 'OK', 'timings': {},
+              'notes': []}
+    start = time.perf_counter()
+    try:
+        if isinstance(gcal, BaseException):
+            raise gcal  # while setting up the calendar
+        process_student(student, report, gcal, templates, erp_pool, resolver, args)
+    except BaseException as e:  # erp and utils call exit() on errors
+        report['status'] = f'Failed: {e!r}'
+    report['total'] = time.perf_counter() - start
+    return report
+
+
+def print_reports(reports):
+    name_width = max(len('Student'), *(len(report['name']) for report in reports))
+    print('Student'.ljust(name_width),
+          *(stage.upper().rjust(7) for stage in STAGES), 'Total'.rjust(7), 'Status')
+    for report in reports:
+        timings = (report['timings'].get(stage) for stage in STAGES)
+        print(report['name'].ljust(name_width),
+              *('-'.rjust(7) if t is None else f'{t:7.2f}' for t in timings),
+              f"{report['total']:7.2f}", report['status'],
+              *(f"({', '.join(report['notes'])})",) if report['notes'] else ())
+    failed = sum(report['status'] != 'OK' for report in reports)
+    print(f'Processed {len(reports)} students, {failed} failed.')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        epilog="With the gcal sink, the flags of the Google sign-in "
+               "(like --noauth_local_webserver) are accepted too.")
+    parser.add_argument('roster', help="Path to the roster TOML file")
+    parser.add_argument(
+        '-w', '--workers',
+        type=int, default=4,
+        help="Number of students to process at once")
+    parser.add_argument(
+        '--erp-concurrency',
+        type=int, default=MAX_CONCURRENCY,
+        help="Maximum number of students to fetch from ERP at once")
+    parser.add_argument(
+        '-t', '--title',
+        default=get_cal_name(),
+        help="Name of the calendar")
+    parser.add_argument(
+        '--sync',
+        action='store_true', default=False,
+        help="Only insert, update or delete the events that have changed")
+    parser.add_argument(
+        '--max-age',
+        type=float, default=None, metavar='MINUTES',
+        help="Reuse the courses fetched from ERP in the last MINUTES minutes")
+    parser.add_argument(
+        '--events',
+        nargs='+', default=['All'],
+        choices=list(EventType.__members__.keys()))
+    parser.add_argument(
+        '--sink',
+        choices=('gcal', 'ics'), default='gcal',
+        help="Create the events in Google Calendar, or write them to .ics files")
+    parser.add_argument(
+        '--ics-dir',
+        default='.',
+        help="Directory to write the .ics file of each student to, by ERP username")
+    parser.add_argument(
+        '--only-affected',
+        action='store_true', default=False,
+        help="Only sync the students affected by the changes since the previous "
+             "revision of the timetable (implies --sync)")
+    cms_group = parser.add_mutually_exclusive_group()
+    cms_group.add_argument(
+        '-s', '--skip-cms',
+        action='store_true', default=False,
+        help="Skip enrolling to CMS courses")
+    cms_group.add_argument(
+        '-o', '--only-cms',
+        action='store_true', default=False,
+        help="Only enrol to CMS courses")
+    args = parse_args(parser)
+    args.events = reduce(ior, (getattr(EventType, event) for event in args.events))
+    args.max_age = args.max_age and args.max_age * 60
+    args.sync = args.sync or args.only_affected
+
+    students = read_toml(args.roster).get('student', [])
+    if args.sink == 'ics':
+        os.makedirs(args.ics_dir, exist_ok=True)
+    course_db.load()  # before the workers start
+    args.revision = None
+    if args.only_affected:
+        old = course_db.read_snapshot(course_db.prev_cache_file)
+        if old is None:
+            print("No previous revision of the timetable found. Syncing everyone.")
+        else:
+            changes = diff_timetables(old, course_db.timetable)
+            print(f"{len(changes)} changes since the previous revision.")
+            args.revision = (old, changes)
+    templates = EventTemplates(args.events)
+    templates.load()
+    erp_pool = ERPPool(args.erp_concurrency)
+    cms_session = make_session(args.workers * CMS_CONCURRENCY)
+    resolver = CourseResolver(CMSClient(session=cms_session))
+
+    # only the credentials are loaded one by one, since expired ones need the
+    # browser flow. The calendars are set up by the workers.
+    gcals = []
+    use_gcal = not args.only_cms and args.sink == 'gcal'
+    if use_gcal:
+        from gcal import GCal
+        from quota import RequestScheduler
+        scheduler = RequestScheduler()  # the API quota is shared by all of them
+    for student in students:
+        if not use_gcal:
+            gcals.append(None)
+            continue
+        print("Loading the Google credentials of", get_student_name(student))
+        try:
+            gcals.append(GCal(credential_path=student['google_creds'],
+                              scheduler=scheduler))
+        except (Exception, SystemExit) as e:  # reported along with the student
+            gcals.append(e)
+
+    if not students:
+        print("No students found in", args.roster)
+        return
+    with ThreadPoolExecutor(args.workers) as executor:
+        reports = list(executor.map(
+            run_student, students, gcals, [templates] * len(students),
+            [erp_pool] * len(students), [resolver] * len(students),
+            [args] * len(students)))
+    print_reports(reports)
+    if use_gcal:
+        print("Calendar API:", scheduler.metrics)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,59 +1,163 @@
-from functools import lru_cache
+import hashlib
+import json
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
 
 import requests
-from utils import config, pprint_json
+from requests.adapters import HTTPAdapter
+from dates import cur_sem, today
+from utils import config, get_cache_path, pprint_json, write_json
 
 REST_URL = config['MOODLE']['address'] + "/webservice/rest/server.php"
-
-
-def make_req(verb, params={}, data=None):
-    query_params = {
-        "wstoken": config['MOODLE']['wstoken'],
-        "moodlewsrestformat": "json",
-    }
-    query_params.update(params)
-    resp = requests.request(verb, REST_URL, params=query_params, data=data)
-    resp = resp.json()
-    if 'exception' in resp:
-        raise Exception('CMS error: ' + resp['message'])
-    return resp
-
-
-def get(wsfunc, params={}):
-    params['wsfunction'] = wsfunc
-    return make_req('get', params)
-
-
-def post(wsfunc, params={}, data={}):
-    params['wsfunction'] = wsfunc
-    return make_req('post', params, data)
-
-
-@lru_cache()
-def get_siteinfo():
-    return get('core_webservice_get_site_info')
-
-
-@lru_cache()
-def get_userid():
-    return get_siteinfo()['userid']
-
-
-@lru_cache()
-def get_enrolled_courses():
-    return get('core_enrol_get_users_courses', {'userid': get_userid()})
-
-
-def search_course(name):
-    data = get('core_course_search_courses',
-               {'criterianame': 'search', 'criteriavalue': name})
-    if data['total']:
-        return data['courses'][0]
-
-
-def enrol(courseid):
-    return post('enrol_self_enrol_user', data={'courseid': courseid})
+MAX_CONCURRENCY = config['MOODLE'].get('max_concurrency', 4)
+# matches the course code and section in the course names, like "CS F111 L1"
+SECTION_PAT = re.compile(r'\b([A-Z]{2,6}\s+[A-Z]{0,2}\d{3,4})\s+([LPT]\d{1,2})\b')
+
+
+def make_session(pool_size=MAX_CONCURRENCY):
+    """Session with a pool of keep-alive connections to Moodle"""
+    session = requests.Session()
+    session.mount(config['MOODLE']['address'], HTTPAdapter(pool_maxsize=pool_size))
+    return session
+
+
+class CMSClient:
+    """Moodle web service client of a single user.
+
+    The session can be shared between the clients of many users, and the
+    responses about the user are cached in the client itself.
+    """
+
+    def __init__(self, wstoken=None, session=None, max_concurrency=MAX_CONCURRENCY):
+        self.wstoken = wstoken or config['MOODLE']['wstoken']
+        self.session = session or make_session(max_concurrency)
+        self.max_concurrency = max_concurrency
+
+    def make_req(self, verb, params={}, data=None):
+        query_params = {
+            "wstoken": self.wstoken,
+            "moodlewsrestformat": "json",
+        }
+        query_params.update(params)
+        resp = self.session.request(verb, REST_URL, params=query_params, data=data)
+        resp = resp.json()
+        if 'exception' in resp:
+            raise Exception('CMS error: ' + resp['message'])
+        return resp
+
+    def get(self, wsfunc, params={}):
+        return self.make_req('get', dict(params, wsfunction=wsfunc))
+
+    def post(self, wsfunc, params={}, data={}):
+        return self.make_req('post', dict(params, wsfunction=wsfunc), data)
+
+    @cached_property
+    def siteinfo(self):
+        return self.get('core_webservice_get_site_info')
+
+    @cached_property
+    def userid(self):
+        return self.siteinfo['userid']
+
+    @cached_property
+    def enrolled_courses(self):
+        return self.get('core_enrol_get_users_courses', {'userid': self.userid})
+
+    @cached_property
+    def enrolled_ids(self):
+        return frozenset(course['id'] for course in self.enrolled_courses)
+
+    def get_all_courses(self):
+        return self.get('core_course_get_courses_by_field')['courses']
+
+    def search_course(self, name):
+        data = self.get('core_course_search_courses',
+                        {'criterianame': 'search', 'criteriavalue': name})
+        if data['total']:
+            return data['courses'][0]
+
+    def enrol(self, courseid):
+        return self.post('enrol_self_enrol_user', data={'courseid': courseid})
+
+    def enrol_many(self, courseids):
+        """Enrol to the courses concurrently.
+
+        Returns the response for each course, or the error raised for it.
+        """
+        def enrol(courseid):
+            try:
+                return self.enrol(courseid)
+            except Exception as e:
+                return e
+
+        with ThreadPoolExecutor(self.max_concurrency) as executor:
+            responses = list(executor.map(enrol, courseids))
+        for name in ('enrolled_courses', 'enrolled_ids'):  # now outdated
+            self.__dict__.pop(name, None)
+        return responses
+
+
+class CourseResolver:
+    """Map of "<course code> <section>" to the id of its Moodle course.
+
+    Built from the list of all the courses on the site in a single request,
+    falling back to searching for the sections which aren't found in it.
+    The map is saved on disk for each site and semester, since the courses
+    are created anew every semester, and can be shared between many users.
+    """
+
+    def __init__(self, client: CMSClient):
+        self.client = client
+        site = hashlib.sha1(config['MOODLE']['address'].encode()).hexdigest()[:12]
+        acad_year = today.year - cur_sem + 1
+        self.cache_file = get_cache_path(
+            'cms-courses', f'{site}-{acad_year}-sem{cur_sem}.json')
+        self.ids = self.read_cache()
+        self._refreshed = False
+        self._missing = set()
+        self._lock = threading.Lock()
+
+    def read_cache(self):
+        try:
+            with open(self.cache_file) as f:
+                ids = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return ids if isinstance(ids, dict) else {}
+
+    def save(self):
+        tmp_file = self.cache_file.with_suffix('.tmp')
+        write_json(tmp_file, self.ids)
+        os.replace(tmp_file, self.cache_file)
+
+    def refresh(self):
+        """Replace the ids with the ones of the courses currently on the site"""
+        ids = {}
+        for course in self.client.get_all_courses():
+            for match in SECTION_PAT.finditer(course['fullname']):
+                code = ' '.join(match[1].split())
+                ids.setdefault(f"{code} {match[2]}", course['id'])
+        self.ids.update(ids)
+        self._refreshed = True
+        self.save()
+
+    def resolve(self, course_code, sec_code):
+        key = f"{course_code} {sec_code}"
+        with self._lock:
+            if key not in self.ids and not self._refreshed:
+                self.refresh()
+            if key not in self.ids and key not in self._missing:
+                course = self.client.search_course(key)
+                if course:
+                    self.ids[key] = course['id']
+                    self.save()
+                else:
+                    self._missing.add(key)
+            return self.ids.get(key)
 
 
 if __name__ == '__main__':
-    pprint_json(get_enrolled_courses())
+    pprint_json(CMSClient().enrolled_courses)
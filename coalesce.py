@@ -0,0 +1,85 @@
+"""Merge the meetings of a section which can share a recurring event.
+
+The timetable lists a section's classes in separate rows, so a section can
+have several meetings in the same room at the same time on different
+weekdays. Such meetings are merged into one meeting on all of their weekdays,
+which needs a single recurring event in the calendar instead of one for each.
+A merge is kept only if the merged event has exactly the same classes as the
+separate ones.
+"""
+from datetime import timedelta as td
+
+from dates import last_workday
+from events import RECURRENCE_DATES
+from models import Course, Meeting, Section, has_wday, iter_wdays
+from timetable import calc_start_date
+from utils import combine_dt
+
+
+def get_instances(meeting):
+    """Dates and times of all the classes of the recurring event of the meeting"""
+    indates, exdates = RECURRENCE_DATES[meeting.wdays]
+    dates = set(indates)
+    day = meeting.start.date()
+    while day <= last_workday:
+        if has_wday(meeting.wdays, day.isoweekday()):
+            dates.add(day)
+        day += td(days=1)
+    dates.difference_update(exdates)
+    start, end = meeting.start.timetz(), meeting.end.timetz()
+    return {(day, start, end, meeting.room) for day in dates}
+
+
+def merge(meetings):
+    wdays = 0
+    for meeting in meetings:
+        wdays |= meeting.wdays
+    start_date = calc_start_date(tuple(iter_wdays(wdays)))
+    first = meetings[0]
+    return Meeting(
+        first.room,
+        wdays,
+        combine_dt(start_date, first.start.time()),
+        combine_dt(start_date, first.end.time()),
+    )
+
+
+def coalesce_meetings(meetings):
+    """Merge the meetings in the same room and at the same time of the day.
+
+    The merged meetings take the place of the first of them, so the order of
+    the meetings is kept.
+    """
+    groups = {}
+    for index, meeting in enumerate(meetings):
+        key = (meeting.room, meeting.start.time(), meeting.end.time())
+        groups.setdefault(key, []).append((index, meeting))
+    coalesced = []  # (index of the first meeting, meeting) pairs
+    for group in groups.values():
+        if len(group) == 1:
+            coalesced.extend(group)
+            continue
+        group_meetings = [meeting for _, meeting in group]
+        merged = merge(group_meetings)
+        instances = set()
+        for meeting in group_meetings:
+            instances |= get_instances(meeting)
+        if get_instances(merged) == instances:
+            coalesced.append((group[0][0], merged))
+        else:
+            coalesced.extend(group)
+    coalesced.sort(key=lambda item: item[0])
+    return tuple(meeting for _, meeting in coalesced)
+
+
+def coalesce_section(section):
+    return Section(section.num, section.instructors, coalesce_meetings(section.sched))
+
+
+def coalesce_course(course):
+    """Course with the fewest meetings in each section, for make_course_events"""
+    if not course:
+        return course
+    return Course(course.code, course.name,
+                  tuple(map(coalesce_section, course.sections)),
+                  course.midsem, course.compre)
@@ -1,58 +1,239 @@
+import json
+import os
 import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
 
 import requests
-from bs4 import BeautifulSoup
-from utils import config, get_weekday, retry_on_conn_error
+from bs4 import BeautifulSoup, SoupStrainer
+from requests.adapters import HTTPAdapter
+from requests.utils import cookiejar_from_dict, dict_from_cookiejar
+from utils import config, get_cache_path, get_weekday, write_json
 
-sess = requests.Session()
+try:
+    import lxml  # noqa: F401
+    FAST_PARSER = 'lxml'
+except ImportError:
+    FAST_PARSER = 'html.parser'
 
 ROOT_URL = config['ERP']['address']
+MAX_CONCURRENCY = config['ERP'].get('max_concurrency', 4)
+SCHED_TABLE_ID = 'WEEKLY_SCHED_HTMLAREA'
+LOGIN_RETRIES = 5
+# the usernames are used in the names of the cache files
+USERNAME_PAT = re.compile(r'\w+', re.ASCII)
 
 
-@retry_on_conn_error
-def login(username, password):
-    login_url = ROOT_URL + '/psp/hcsprod/?cmd=login&languageCd=ENG'
-    payload = {'userid': username, 'pwd': password}
-    r = sess.post(login_url, data=payload)
-    if r.url[-1] == 'T':
-        print('Logged in to ERP.')
-    else:
-        print('Login unsuccessful for ERP.')
-        exit()
+class ERPLoginError(Exception):
+    pass
+
+
+class ERPConnectionError(ConnectionError):
+    pass
+
+
+def get_week_start():
+    """Monday of the current week, as of the call, for long running processes"""
+    return get_weekday(0, date.today())
+
+
+def is_valid_username(username):
+    return isinstance(username, str) and USERNAME_PAT.fullmatch(username) is not None
+
+
+def find_element(html, name, id_=None):
+    """Parse only the required element out of the page.
+
+    Uses lxml when available. Falls back to parsing the whole page with
+    html.parser in case the element got lost in the filtered parse.
+    """
+    soup = BeautifulSoup(html, FAST_PARSER, parse_only=SoupStrainer(name, id=id_))
+    element = soup.find(name, id=id_)
+    if element is None:
+        element = BeautifulSoup(html, 'html.parser').find(name, id=id_)
+    return element
 
 
-def post_form(src, **kwargs):
-    """Post a form after changing some of its fields."""
-    soup = BeautifulSoup(src.text, 'html.parser')
-    form = soup.find('form', id=kwargs.get('form_id'))
-    form_url = kwargs.get('form_url') or form['action']
+def get_form_fields(form):
     payload = {}
     for field in form.find_all('input'):
         try:
             payload[field['name']] = field['value']
         except KeyError:
             pass
-    for key, value in kwargs.get('post_data', {}).items():
-        payload[key] = value
-    return sess.post(form_url, payload)
-
-
-def get_weekly_sched(start_date=get_weekday(0)):
-    url = (ROOT_URL + '/psc/hcsprod/EMPLOYEE/HRMS/c/'
-           'SA_LEARNER_SERVICES.SSR_SSENRL_SCHD_W.GBL')
-    r = sess.get(url)
-    payload = {
-        'DERIVED_CLASS_S_START_DT': start_date.strftime('%d/%m/%Y'),
-        'DERIVED_CLASS_S_MEETING_TIME_END': '6:00PM',
-        'DERIVED_CLASS_S_SUNDAY_LBL': 'N',
-        'ICAction': 'DERIVED_CLASS_S_SSR_NEXT_WEEK'
-    }
-    response = post_form(r, post_data=payload, form_url=r.url)
-    soup = BeautifulSoup(response.text, 'html.parser')
-    rows = soup.find('table', id='WEEKLY_SCHED_HTMLAREA').find_all('tr')
+    return payload
+
+
+def get_sched_rows(table):
+    rows = table.find_all('tr')
     return [[cell.text for cell in row.find_all('td')[1:]] for row in rows[1:]]
 
 
+def is_logged_out(response):
+    """Check if ERP sent us to the login page, i.e., the session has expired"""
+    return ('cmd=login' in response.url or 'cmd=expire' in response.url
+            or 'name="userid"' in response.text)
+
+
+def read_sched_cache(cache_file):
+    """Sections and fetch time of the cached schedule, or None if it is unusable"""
+    try:
+        with open(cache_file) as f:
+            cached = json.load(f)
+        sections = {code: set(secs) for code, secs in cached['sections'].items()}
+        return sections, float(cached['fetched'])
+    except (OSError, ValueError, KeyError, TypeError, AttributeError):
+        return None
+
+
+class ERPClient:
+    """ERP session of a single user.
+
+    The session cookies are saved to disk, so that later runs can skip logging
+    in until the session expires.
+    """
+
+    def __init__(self, username, password, session=None, persist_cookies=True):
+        if not is_valid_username(username):
+            raise ERPLoginError(f'Invalid ERP username {username!r}')
+        self.username = username
+        self.password = password
+        self.session = session or requests.Session()
+        self.cookie_file = None
+        if persist_cookies:
+            self.cookie_file = get_cache_path('erp-cookies', f'{username}.json')
+            self.load_cookies()
+
+    def load_cookies(self):
+        try:
+            with open(self.cookie_file) as f:
+                cookies = json.load(f)
+        except (OSError, ValueError):
+            return  # no usable cookies, so log in again
+        if isinstance(cookies, dict) and all(
+                isinstance(item, str) for pair in cookies.items() for item in pair):
+            self.session.cookies.update(cookiejar_from_dict(cookies))
+
+    def save_cookies(self):
+        if not self.cookie_file:
+            return
+        self.cookie_file.touch(mode=0o600)
+        with open(self.cookie_file, 'w') as f:
+            json.dump(dict_from_cookiejar(self.session.cookies), f)
+
+    def login(self):
+        login_url = ROOT_URL + '/psp/hcsprod/?cmd=login&languageCd=ENG'
+        payload = {'userid': self.username, 'pwd': self.password}
+        for _ in range(LOGIN_RETRIES):
+            try:
+                r = self.session.post(login_url, data=payload)
+                break
+            except requests.exceptions.ConnectionError:
+                print("Connection Error. Retrying.")
+        else:
+            raise ERPConnectionError(
+                f"Couldn't connect to ERP at {ROOT_URL}. Maximum retries exceeded.")
+        if r.url[-1] != 'T':
+            raise ERPLoginError(f'Login unsuccessful for ERP user {self.username}')
+        print('Logged in to ERP.')
+        self.save_cookies()
+
+    def post_form(self, src, **kwargs):
+        """Post a form after changing some of its fields."""
+        form = find_element(src.text, 'form', kwargs.get('form_id'))
+        form_url = kwargs.get('form_url') or form['action']
+        payload = get_form_fields(form)
+        for key, value in kwargs.get('post_data', {}).items():
+            payload[key] = value
+        return self.session.post(form_url, payload)
+
+    def get_weekly_sched(self, start_date=None):
+        start_date = start_date or get_week_start()
+        url = (ROOT_URL + '/psc/hcsprod/EMPLOYEE/HRMS/c/'
+               'SA_LEARNER_SERVICES.SSR_SSENRL_SCHD_W.GBL')
+        r = self.session.get(url)
+        if is_logged_out(r):
+            self.login()
+            r = self.session.get(url)
+        payload = {
+            'DERIVED_CLASS_S_START_DT': start_date.strftime('%d/%m/%Y'),
+            'DERIVED_CLASS_S_MEETING_TIME_END': '6:00PM',
+            'DERIVED_CLASS_S_SUNDAY_LBL': 'N',
+            'ICAction': 'DERIVED_CLASS_S_SSR_NEXT_WEEK'
+        }
+        response = self.post_form(r, post_data=payload, form_url=r.url)
+        self.save_cookies()
+        return get_sched_rows(find_element(response.text, 'table', SCHED_TABLE_ID))
+
+    def get_reg_sections(self, max_age=None, start_date=None):
+        """Get the registered sections and the courses changed since last time.
+
+        The schedule is cached on disk, and the cached copy is used without
+        contacting ERP if it is less than `max_age` seconds old.
+        """
+        start_date = start_date or get_week_start()
+        cache_file = get_cache_path(
+            'erp-sched', f'{self.username}-{start_date.isoformat()}.json')
+        cached = read_sched_cache(cache_file)
+        if cached:
+            old_sections, fetched = cached
+            if max_age is not None and time.time() - fetched <= max_age:
+                return old_sections, set()
+        else:
+            old_sections = {}
+
+        try:
+            if not self.session.cookies:
+                self.login()
+            rows = self.get_weekly_sched(start_date)
+        except requests.exceptions.RequestException as e:
+            raise ERPConnectionError(f"Failed to fetch the schedule from ERP: {e}") from e
+        sections = parse_tt(rows)
+        tmp_file = cache_file.with_suffix('.tmp')
+        write_json(tmp_file, {
+            'fetched': time.time(),
+            'rows': rows,
+            'sections': {code: sorted(secs) for code, secs in sections.items()}
+        })
+        os.replace(tmp_file, cache_file)  # a partial write would corrupt the cache
+        return sections, diff_sections(old_sections, sections)
+
+
+class ERPPool:
+    """Scrape the schedules of many users concurrently.
+
+    The sessions of all the users share one connection pool, and at most
+    `max_concurrency` users are handled at once, to avoid overloading ERP.
+    """
+
+    def __init__(self, max_concurrency=MAX_CONCURRENCY):
+        self.max_concurrency = max_concurrency
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        self._semaphore = threading.BoundedSemaphore(max_concurrency)
+
+    def make_client(self, creds):
+        session = requests.Session()
+        session.mount(ROOT_URL, self.adapter)
+        return ERPClient(**creds, session=session)
+
+    def get_reg_sections(self, creds, max_age=None):
+        with self._semaphore:
+            return self.make_client(creds).get_reg_sections(max_age)
+
+    def get_all_reg_sections(self, all_creds, max_age=None):
+        """Get the registered sections of each user, or the error raised for it"""
+        def scrape(creds):
+            try:
+                return self.get_reg_sections(creds, max_age)
+            except Exception as e:
+                return e
+
+        with ThreadPoolExecutor(self.max_concurrency) as executor:
+            return list(executor.map(scrape, all_creds))
+
+
 def parse_tt(week):
     pattern = re.compile(r'(\S+)\s+(\S+) - ([A-Z]+\d+)')
     courses = {}
@@ -67,9 +248,19 @@ def parse_tt(week):
     return courses
 
 
-def get_reg_sections():
-    login(**config['ERP']['CREDS'])
-    return parse_tt(get_weekly_sched())
+def diff_sections(old, new):
+    """Get the courses whose sections differ between the two schedules"""
+    return {code for code in old.keys() | new.keys() if old.get(code) != new.get(code)}
+
+
+def get_reg_sections(creds=None, max_age=None):
+    """Get the registered sections of the user from the config"""
+    client = ERPClient(**(creds or config['ERP']['CREDS']))
+    try:
+        return client.get_reg_sections(max_age)
+    except (ERPLoginError, ERPConnectionError) as e:
+        print(e)
+        exit()
 
 
 if __name__ == '__main__':
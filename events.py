@@ -1,10 +1,13 @@
+import hashlib
+import json
 from collections import defaultdict
 from datetime import timedelta as td
-from functools import partial
+from functools import lru_cache
 
 from dates import (RFC_WEEKDAYS, last_workday, day_changes as CHANGE_DATES,
                    midsem_dates as MIDSEM_DATES, holidays as HOLIDAYS)
-from utils import combine_dt
+from models import has_wday, iter_wdays
+from utils import SYNC_HASH, SYNC_KEY
 from enum import Flag, auto
 
 
@@ -15,7 +18,6 @@ class EventType(Flag):
     All = Lectures | Midsem | Compre
 
 
-DATE_FMT = '%Y%m%dT%H%M%S'
 RFC_WDAY = tuple(RFC_WEEKDAYS.values())
 COLORS = {'event': {'L': '9', 'P': '6', 'T': '10'},
           'midsem': '4', 'compre': '7'}
@@ -24,60 +26,89 @@ INCLUDE_DATES = defaultdict(list)
 for change_date, day in CHANGE_DATES.items():
     INCLUDE_DATES[day].append(change_date)
 LAST_DATE = (last_workday + td(days=1)).strftime('%Y%m%d')
+MIDSEM_DAYS = ()
+if MIDSEM_DATES:
+    MIDSEM_DAYS = tuple(
+        MIDSEM_DATES['start'] + td(days=offset)
+        for offset in range((MIDSEM_DATES['end'] - MIDSEM_DATES['start']).days + 1))
 
 
-def join_event_dt(event, date_):
-    return combine_dt(date_, event['start'].time()).strftime(DATE_FMT)
+def get_recurrence_dates(wdays):
+    """Extra dates and excluded dates of the weekly events on the given weekdays"""
+    indates = set()
+    for wday in iter_wdays(wdays):
+        indates.update(INCLUDE_DATES.get(RFC_WDAY[wday - 1], []))
+    exdates = HOLIDAYS.copy()
+    exdates.update(day for day in MIDSEM_DAYS if has_wday(wdays, day.isoweekday()))
+    exdates.update(
+        change_date for change_date in CHANGE_DATES
+        if has_wday(wdays, change_date.isoweekday()) and change_date not in indates)
+    return tuple(sorted(indates)), tuple(sorted(exdates))
 
 
-def get_indates(event):
-    indates = set()
-    for wday in event['wdays']:
-        dates = INCLUDE_DATES.get(RFC_WDAY[wday - 1], [])
-        indates.update(dates)
-    return indates
+# for every weekday bitmask, computed once along with the academic calendar
+RECURRENCE_DATES = tuple(map(get_recurrence_dates, range(1 << len(RFC_WDAY))))
 
 
-def get_exdates(event, indates):
-    exdates = HOLIDAYS.copy()
-    if MIDSEM_DATES:
-        midsem_date = MIDSEM_DATES['start']
-        while midsem_date <= MIDSEM_DATES['end']:
-            if midsem_date.isoweekday() in event['wdays']:
-                exdates.add(midsem_date)
-            midsem_date = midsem_date + td(days=1)
-    for change_date in CHANGE_DATES:
-        if change_date.isoweekday() in event['wdays'] and change_date not in indates:
-            exdates.add(change_date)
-    return exdates
-
-
-def make_section_events(course_name, section):
-    for event in section['sched']:
-        rrule = {
-            'FREQ': 'WEEKLY',
-            'BYDAY': ','.join(RFC_WDAY[day - 1] for day in event['wdays']),
-            'UNTIL': LAST_DATE
-        }
-        get_dt = partial(join_event_dt, event)
-        indates = get_indates(event)
-        exdates = get_exdates(event, indates)
+@lru_cache(maxsize=None)
+def get_recurrence(wdays, start_time):
+    """Recurrence rules of the weekly events on the weekdays, at the start time"""
+    indates, exdates = RECURRENCE_DATES[wdays]
+    rrule = {
+        'FREQ': 'WEEKLY',
+        'BYDAY': ','.join(RFC_WDAY[day - 1] for day in iter_wdays(wdays)),
+        'UNTIL': LAST_DATE
+    }
+    recurrence = ['RRULE:' + ";".join(f"{k}={v}" for k, v in rrule.items())]
+    suffix = start_time.strftime('T%H%M%S')
+    if indates:
+        recurrence.append('RDATE;TZID=Asia/Kolkata:' + ','.join(
+            indate.strftime('%Y%m%d') + suffix for indate in indates))
+    if exdates:
+        recurrence.append('EXDATE;TZID=Asia/Kolkata:' + ','.join(
+            exdate.strftime('%Y%m%d') + suffix for exdate in exdates))
+    return tuple(recurrence)
+
+
+def tag_event(event, key):
+    """Attach a stable key and a fingerprint of the contents to the event.
+
+    These are used to find the events that need to be changed while syncing.
+    """
+    data = json.dumps(event, sort_keys=True).encode()
+    event['extendedProperties'] = {
+        'private': {SYNC_KEY: key, SYNC_HASH: hashlib.sha1(data).hexdigest()}
+    }
+    return event
 
+
+def get_section_key(course_code, sec_num, index):
+    """Sync key of the index-th event of the section.
+
+    Made from the course code, since the titles of courses aren't unique.
+    """
+    return f'{course_code} {sec_num}#{index}'
+
+
+def get_exam_key(course_code, exam):
+    return f'{course_code} {exam}'
+
+
+def make_section_events(course, section):
+    for index, event in enumerate(section.sched):
         gcal_event = {
-            'summary': f"{course_name} {section['num']}",
-            'description': section['instructors'],
-            'location': event['room'],
+            'summary': f"{course.name} {section.num}",
+            'description': ', '.join(section.instructors),
+            'location': event.room,
             'start': {
-                'dateTime': event['start'].isoformat(),
+                'dateTime': event.start.isoformat(),
                 'timeZone': 'Asia/Kolkata'
             },
             'end': {
-                'dateTime': event['end'].isoformat(),
+                'dateTime': event.end.isoformat(),
                 'timeZone': 'Asia/Kolkata'
             },
-            'recurrence': [
-                'RRULE:' + ";".join(f"{k}={v}" for k, v in rrule.items()),
-            ],
+            'recurrence': list(get_recurrence(event.wdays, event.start.time())),
             'reminders': {
                 'useDefault': False,
                 'overrides': [
@@ -87,19 +118,13 @@ def make_section_events(course_name, section):
                     }
                 ]
             },
-            'colorId': COLORS['event'][section['num'][0]]
+            'colorId': COLORS['event'][section.num[0]]
         }
-        if indates:
-            gcal_event['recurrence'].append(
-                'RDATE;TZID=Asia/Kolkata:' + ','.join(map(get_dt, indates)))
-        if exdates:
-            gcal_event['recurrence'].append(
-                'EXDATE;TZID=Asia/Kolkata:' + ','.join(map(get_dt, exdates)))
-        yield gcal_event
+        yield tag_event(gcal_event, get_section_key(course.code, section.num, index))
 
 
-def make_event(title, start, end, color):
-    return {
+def make_event(title, start, end, color, key):
+    return tag_event({
         'summary': title,
         'start': {
             'dateTime': start.isoformat(),
@@ -110,29 +135,26 @@ def make_event(title, start, end, color):
             'timeZone': 'Asia/Kolkata'
         },
         'colorId': color
-    }
+    }, key)
 
 
-def make_midsem_event(course_name, midsem):
-    return make_event(course_name + ' Midsem', midsem['start'],
-                      midsem['end'], COLORS['midsem'])
+def make_midsem_event(course):
+    midsem = course.midsem
+    return make_event(course.name + ' Midsem', midsem.start, midsem.end,
+                      COLORS['midsem'], get_exam_key(course.code, 'Midsem'))
 
 
-def make_compre_event(course_name, compre):
-    return make_event(course_name + ' Compre', compre['start'],
-                      compre['end'], COLORS['compre'])
+def make_compre_event(course):
+    compre = course.compre
+    return make_event(course.name + ' Compre', compre.start, compre.end,
+                      COLORS['compre'], get_exam_key(course.code, 'Compre'))
 
 
 def make_course_events(course, event_types=EventType.All):
-    name = course['name']
     if event_types & EventType.Lectures:
-        for section in course['sections']:
-            yield from make_section_events(name, section)
-    if event_types & EventType.Midsem:
-        midsem = course.get('midsem')
-        if midsem:
-            yield make_midsem_event(name, midsem)
-    if event_types & EventType.Compre:
-        compre = course.get('compre')
-        if compre:
-            yield make_compre_event(name, compre)
+        for section in course.sections:
+            yield from make_section_events(course, section)
+    if event_types & EventType.Midsem and course.midsem:
+        yield make_midsem_event(course)
+    if event_types & EventType.Compre and course.compre:
+        yield make_compre_event(course)
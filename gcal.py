@@ -1,25 +1,34 @@
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime as dt
 from datetime import timedelta as td
+from functools import lru_cache
 
 import httplib2
-from apiclient.discovery import build
+from apiclient.discovery import DISCOVERY_URI, build_from_document
 from googleapiclient.errors import HttpError
 from oauth2client import client, tools
 from oauth2client.file import Storage
-from utils import combine_dt, find_entity
+from quota import RequestScheduler
+from utils import chunked, combine_dt, find_entity, get_cache_path, get_sync_tag
 
 SCOPES = "https://www.googleapis.com/auth/calendar"
 CLIENT_SECRET_FILE = "client_secret.json"
 APPLICATION_NAME = "ERP to Google Calendar"
+BATCH_SIZE = 50  # Calendar API rejects batches larger than this
+MAX_CONCURRENT_BATCHES = 4
+DISCOVERY_MAX_AGE = 30 * 24 * 60 * 60  # refresh the cached discovery doc monthly
 
 
-def get_credentials(new_creds=False):
-    home_dir = os.path.expanduser("~")
-    credential_dir = os.path.join(home_dir, ".local", "google-creds")
-    if not os.path.exists(credential_dir):
-        os.makedirs(credential_dir)
-    credential_path = os.path.join(credential_dir, "erp-gcal-creds.json")
+def get_credentials(new_creds=False, credential_path=None):
+    if not credential_path:
+        home_dir = os.path.expanduser("~")
+        credential_dir = os.path.join(home_dir, ".local", "google-creds")
+        if not os.path.exists(credential_dir):
+            os.makedirs(credential_dir)
+        credential_path = os.path.join(credential_dir, "erp-gcal-creds.json")
 
     store = Storage(credential_path)
     credentials = None if new_creds else store.get()
@@ -33,16 +42,75 @@ def get_credentials(new_creds=False):
     return credentials
 
 
-def create_cal_serv(new_creds=False):
-    credentials = get_credentials(new_creds)
+def fetch_discovery_doc(api, version):
+    try:  # bundled with google-api-python-client>=2.0
+        from googleapiclient.discovery_cache import get_static_doc
+    except ImportError:
+        pass
+    else:
+        doc = get_static_doc(api, version)
+        if doc:
+            return doc
+    resp, content = httplib2.Http(timeout=10).request(
+        DISCOVERY_URI.format(api=api, apiVersion=version)
+    )
+    if resp.status != 200:
+        raise HttpError(resp, content)
+    return content.decode()
+
+
+@lru_cache()
+def get_discovery_doc(api="calendar", version="v3"):
+    """Discovery document of the API, cached so that startup doesn't need the network"""
+    path = get_cache_path("discovery", f"{api}.{version}.json")
+    try:
+        age = time.time() - path.stat().st_mtime
+    except FileNotFoundError:
+        age = None
+    if age is not None and age < DISCOVERY_MAX_AGE:
+        return path.read_text(encoding="utf-8")
+    try:
+        doc = fetch_discovery_doc(api, version)
+    except (HttpError, httplib2.HttpLib2Error, OSError) as e:
+        if age is None:
+            raise
+        print(f"Failed to refresh the discovery document ({e}), using the cached one.")
+        return path.read_text(encoding="utf-8")
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.write_text(doc, encoding="utf-8")
+    os.replace(tmp_path, path)
+    return doc
+
+
+def create_cal_serv(new_creds=False, credentials=None):
+    credentials = credentials or get_credentials(new_creds)
     http = credentials.authorize(httplib2.Http())
-    return build("calendar", "v3", http=http)
+    return build_from_document(get_discovery_doc(), http=http)
 
 
 class GCal:
-    def __init__(self, new_creds=False, cal_id="primary"):
+    def __init__(
+        self, new_creds=False, cal_id="primary", credential_path=None, scheduler=None
+    ):
         self.cal_id = cal_id
-        self.service = create_cal_serv(new_creds)
+        self.credentials = get_credentials(new_creds, credential_path)
+        self.service = create_cal_serv(credentials=self.credentials)
+        self.scheduler = scheduler or RequestScheduler()
+        self._local = threading.local()
+
+    def _get_http(self):
+        """Get an authorized Http object for the current thread.
+
+        httplib2 isn't thread safe, so concurrent batches need their own.
+        """
+        http = getattr(self._local, "http", None)
+        if http is None:
+            http = self._local.http = self.credentials.authorize(httplib2.Http())
+        return http
+
+    def execute(self, request):
+        """Execute the request through the scheduler, on this thread's Http"""
+        return self.scheduler.execute(request, http=self._get_http())
 
     def get_all_entities(self, entity_name, verb="list", **kwargs):
         entity_serv = getattr(self.service, entity_name)
@@ -50,9 +118,9 @@ class GCal:
         assert getattr(entity_serv(), verb), "Invalid verb"
         page_token = None
         while True:
-            entities = getattr(entity_serv(), verb)(
-                pageToken=page_token, **kwargs
-            ).execute()
+            entities = self.execute(
+                getattr(entity_serv(), verb)(pageToken=page_token, **kwargs)
+            )
             for entity in entities["items"]:
                 yield entity
             page_token = entities.get("nextPageToken")
@@ -66,22 +134,118 @@ class GCal:
         return self.get_all_entities("events", calendarId=self.cal_id, **params)
 
     def delete_event(self, event):
-        return (
-            self.service.events()
-            .delete(calendarId=self.cal_id, eventId=event["id"])
-            .execute()
+        return self.execute(
+            self.service.events().delete(calendarId=self.cal_id, eventId=event["id"])
         )
 
     def create_event(self, event):
+        return self.execute(
+            self.service.events().insert(calendarId=self.cal_id, body=event)
+        )
+
+    def execute_batched(self, requests, concurrency=1):
+        """Execute the requests in batches of BATCH_SIZE.
+
+        Up to `concurrency` batches are sent at the same time.
+        Returns two lists, with the responses and the errors respectively,
+        each in the form of (index, value) pairs.
+        """
+        results, failures = [], []
+
+        def execute(chunk):
+            responses, errors = self.scheduler.execute_batch(
+                lambda callback: self.service.new_batch_http_request(callback=callback),
+                ((str(index), request) for index, request in chunk),
+                http=self._get_http(),
+            )
+            results.extend((int(index), resp) for index, resp in responses.items())
+            failures.extend((int(index), error) for index, error in errors.items())
+
+        chunks = chunked(enumerate(requests), BATCH_SIZE)
+        if concurrency > 1:
+            with ThreadPoolExecutor(concurrency) as executor:
+                for _ in executor.map(execute, chunks):
+                    pass
+        else:
+            for chunk in chunks:
+                execute(chunk)
+        results.sort(key=lambda result: result[0])
+        failures.sort(key=lambda failure: failure[0])
+        return results, failures
+
+    def create_events(self, events):
+        """Insert multiple events using batch requests.
+
+        Returns the list of (event, created_event) pairs for the successful
+        inserts and (event, error) pairs for the failed ones.
+        """
+        events = list(events)
+        requests = [
+            self.service.events().insert(calendarId=self.cal_id, body=event)
+            for event in events
+        ]
+        results, failures = self.execute_batched(requests)
         return (
-            self.service.events().insert(calendarId=self.cal_id, body=event).execute()
+            [(events[index], created) for index, created in results],
+            [(events[index], error) for index, error in failures],
         )
 
+    def sync_events(self, events):
+        """Make the calendar contain exactly the given events.
+
+        The events must be tagged with a key and fingerprint (see
+        `events.tag_event`). The calendar is listed once, and then only the new
+        events are inserted, the changed ones are patched and the stale or
+        untagged ones are deleted.
+        Returns the list of (action, event) pairs for the successful requests
+        and (action, event, error) triplets for the failed ones.
+        """
+        existing = {}
+        stale = []
+        for event in self.get_all_events():
+            if "recurringEventId" in event:
+                continue  # a modified instance, which goes along with its master
+            key, _ = get_sync_tag(event)
+            if key is None or key in existing:
+                stale.append(event)
+            else:
+                existing[key] = event
+
+        actions = []
+        events_serv = self.service.events()
+        for event in events:
+            key, fingerprint = get_sync_tag(event)
+            old_event = existing.pop(key, None)
+            if old_event is None:
+                request = events_serv.insert(calendarId=self.cal_id, body=event)
+                actions.append(("Created", event, request))
+            elif get_sync_tag(old_event)[1] != fingerprint:
+                request = events_serv.patch(
+                    calendarId=self.cal_id, eventId=old_event["id"], body=event
+                )
+                actions.append(("Updated", event, request))
+        stale.extend(existing.values())
+        for event in stale:
+            request = events_serv.delete(calendarId=self.cal_id, eventId=event["id"])
+            actions.append(("Deleted", event, request))
+
+        results, failures = self.execute_batched(
+            [request for *_, request in actions]
+        )
+        failed = []
+        for index, error in failures:
+            action, event, _ = actions[index]
+            if action == "Deleted" and error.resp.status == 410:
+                results.append((index, None))  # already deleted
+            else:
+                failed.append((action, event, error))
+        return [actions[index][:2] for index, _ in sorted(results)], failed
+
     def patch_event(self, event, data):
-        return (
-            self.service.events()
-            .patch(calendarId=self.cal_id, eventId=event["id"], body=data)
-            .execute()
+        return self.execute(
+            self.service.events().patch(
+                calendarId=self.cal_id, eventId=event["id"], body=data
+            )
         )
 
     def get_event_instances(self, event, **params):
@@ -90,7 +254,7 @@ class GCal:
         )
 
     def create_cal(self, calendar):
-        return self.service.calendars().insert(body=calendar).execute()
+        return self.execute(self.service.calendars().insert(body=calendar))
 
     def find_event(self, event):
         events = self.get_all_events()
@@ -116,14 +280,48 @@ class GCal:
             return
         self.cal_id = cal["id"]
 
-    def clear_cal(self):
-        for event in self.get_all_events():
-            self.print_event(event, "Deleting")
-            try:
-                self.delete_event(event)
-            except HttpError as err:
-                if err.resp.status != 410:
-                    raise err
+    def delete_events(self, events, concurrency=MAX_CONCURRENT_BATCHES):
+        """Delete multiple events using concurrent batch requests.
+
+        Events which were already deleted are treated as successful.
+        Returns the list of deleted events and (event, error) pairs for the
+        failed ones.
+        """
+        events = list(events)
+        requests = [
+            self.service.events().delete(calendarId=self.cal_id, eventId=event["id"])
+            for event in events
+        ]
+        results, failures = self.execute_batched(requests, concurrency)
+        deleted = [events[index] for index, _ in results]
+        failed = []
+        for index, error in failures:
+            if error.resp.status == 410:
+                deleted.append(events[index])
+            else:
+                failed.append((events[index], error))
+        return deleted, failed
+
+    def recreate_cal(self):
+        """Delete the current calendar and create an empty one in its place.
+
+        Costs a constant number of requests, unlike deleting all the events.
+        """
+        assert self.cal_id != "primary", "Can't delete the primary calendar"
+        old_cal = self.execute(self.service.calendars().get(calendarId=self.cal_id))
+        self.execute(self.service.calendars().delete(calendarId=self.cal_id))
+        fields = ("summary", "description", "location", "timeZone")
+        calendar = {field: old_cal[field] for field in fields if field in old_cal}
+        self.cal_id = self.create_cal(calendar)["id"]
+
+    def clear_cal(self, recreate=False, concurrency=MAX_CONCURRENT_BATCHES):
+        if recreate:
+            return self.recreate_cal()
+        deleted, failed = self.delete_events(self.get_all_events(), concurrency)
+        for event in deleted:
+            self.print_event(event, "Deleted")
+        if failed:
+            raise failed[0][1]
 
     def clear_day(self, date: dt, only_recurring=True):
         """Clear all event instances of a particular date"""
@@ -131,13 +329,18 @@ class GCal:
         date = combine_dt(date.date())
         next_day = date + td(days=1)
         min_date, max_date = date.isoformat(), next_day.isoformat()
-        for event in self.get_all_events(
+        events = self.get_all_events(
             timeMin=min_date, timeMax=max_date, singleEvents=True
-        ):
-            if only_recurring and "recurringEventId" not in event:
-                continue
-            self.print_event(event, "Deleting")
-            self.delete_event(event)
+        )
+        deleted, failed = self.delete_events(
+            event
+            for event in events
+            if not only_recurring or "recurringEventId" in event
+        )
+        for event in deleted:
+            self.print_event(event, "Deleted")
+        if failed:
+            raise failed[0][1]
         print("Cleared all events for", date.strftime("%a, %d/%m/%Y"))
 
     @staticmethod
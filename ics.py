@@ -0,0 +1,147 @@
+"""Write the events as an iCalendar (.ics) file, instead of creating them in GCal.
+
+The events are the same dicts as the ones sent to the Calendar API (see
+events.py). The recurrence rules of the API are already in the iCalendar
+format, so they are written almost as they are. The output is streamed, one
+event at a time.
+"""
+import hashlib
+import re
+from datetime import datetime, timezone
+
+from events import COLORS
+from utils import IST, get_sync_tag
+
+TZID = 'Asia/Kolkata'
+PRODID = '-//erp-gcal//Timetable//EN'
+MAX_LINE_OCTETS = 75
+UNTIL_DATE_PAT = re.compile(r'UNTIL=(\d{8})(?=;|$)')
+VTIMEZONE = (
+    'BEGIN:VTIMEZONE',
+    f'TZID:{TZID}',
+    'BEGIN:STANDARD',
+    'DTSTART:19700101T000000',
+    'TZOFFSETFROM:+0530',
+    'TZOFFSETTO:+0530',
+    'TZNAME:IST',
+    'END:STANDARD',
+    'END:VTIMEZONE',
+)
+# the names of the GCal colors used by the events, as iCalendar categories
+CATEGORIES = {COLORS['midsem']: 'Midsem', COLORS['compre']: 'Compre',
+              **{color: sec_type for sec_type, color in COLORS['event'].items()}}
+
+
+def escape(text):
+    return (text.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,')
+            .replace('\r\n', '\\n').replace('\n', '\\n'))
+
+
+def fold(line):
+    """Split the content line into lines of at most 75 octets, ending in CRLF"""
+    data = line.encode()
+    if len(data) <= MAX_LINE_OCTETS:
+        return line + '\r\n'
+    parts = []
+    limit = MAX_LINE_OCTETS
+    while len(data) > limit:
+        cut = limit
+        while data[cut] & 0xC0 == 0x80:  # inside a multi-byte character
+            cut -= 1
+        parts.append(data[:cut])
+        data = data[cut:]
+        limit = MAX_LINE_OCTETS - 1  # for the leading space
+    parts.append(data)
+    return b'\r\n '.join(parts).decode() + '\r\n'
+
+
+def format_dt(event_time):
+    """Local time of the start/end of the event, with its TZID parameter"""
+    local = datetime.fromisoformat(event_time['dateTime']).strftime('%Y%m%dT%H%M%S')
+    return f";TZID={event_time.get('timeZone', TZID)}:{local}"
+
+
+def format_rule(line):
+    """The UNTIL of the rule must be a UTC date-time, like the DTSTART.
+
+    The API accepts a date, which is taken as the midnight in the event's timezone.
+    """
+    def to_utc(match):
+        until = datetime.strptime(match[1], '%Y%m%d').replace(tzinfo=IST())
+        return 'UNTIL=' + until.astimezone(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+    return UNTIL_DATE_PAT.sub(to_utc, line) if line.startswith('RRULE:') else line
+
+
+def get_uid(event):
+    key, _ = get_sync_tag(event)
+    digest = hashlib.sha1((key or event['summary']).encode()).hexdigest()
+    return f'{digest}@erp-gcal'
+
+
+def event_lines(event, dtstamp):
+    """Content lines of the VEVENT of the event"""
+    yield 'BEGIN:VEVENT'
+    yield f'UID:{get_uid(event)}'
+    yield f'DTSTAMP:{dtstamp}'
+    yield 'DTSTART' + format_dt(event['start'])
+    yield 'DTEND' + format_dt(event['end'])
+    yield f"SUMMARY:{escape(event['summary'])}"
+    for prop, field in (('DESCRIPTION', 'description'), ('LOCATION', 'location')):
+        if event.get(field):
+            yield f'{prop}:{escape(event[field])}'
+    if event.get('colorId') in CATEGORIES:
+        yield f"CATEGORIES:{CATEGORIES[event['colorId']]}"
+    yield from map(format_rule, event.get('recurrence', ()))
+    for reminder in event.get('reminders', {}).get('overrides', ()):
+        yield 'BEGIN:VALARM'
+        yield 'ACTION:DISPLAY'
+        yield f"DESCRIPTION:{escape(event['summary'])}"
+        yield f"TRIGGER:-PT{reminder['minutes']}M"
+        yield 'END:VALARM'
+    yield 'END:VEVENT'
+
+
+def get_dtstamp():
+    return datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+
+def make_fragment(events, dtstamp):
+    """Folded VEVENTs of the events, to be put in any calendar as they are"""
+    return ''.join(fold(line) for event in events for line in event_lines(event, dtstamp))
+
+
+def calendar_header(name=None):
+    lines = ['BEGIN:VCALENDAR', 'VERSION:2.0', f'PRODID:{PRODID}',
+             'CALSCALE:GREGORIAN', 'METHOD:PUBLISH', f'X-WR-TIMEZONE:{TZID}']
+    if name:
+        lines.append(f'X-WR-CALNAME:{escape(name)}')
+    lines.extend(VTIMEZONE)
+    return ''.join(map(fold, lines))
+
+
+CALENDAR_FOOTER = fold('END:VCALENDAR')
+
+
+def iter_calendar(events, name=None, dtstamp=None):
+    """Folded lines of the whole calendar, generated as the events are consumed"""
+    dtstamp = dtstamp or get_dtstamp()
+    yield calendar_header(name)
+    for event in events:
+        for line in event_lines(event, dtstamp):
+            yield fold(line)
+    yield CALENDAR_FOOTER
+
+
+def write_calendar(path, events, name=None):
+    """Write the events to the .ics file, and return the number of events"""
+    count = 0
+
+    def counted():
+        nonlocal count
+        for count, event in enumerate(events, 1):
+            yield event
+
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        f.writelines(iter_calendar(counted(), name))
+    return count
@@ -1,18 +1,24 @@
 import argparse
 from functools import reduce
 from operator import ior
+from typing import TYPE_CHECKING
 
 import cms
 import erp
+from coalesce import coalesce_course
 from dates import cur_sem, today
 from events import make_course_events, EventType
-from gcal import GCal, tools
+from ics import write_calendar
 from timetable import get_course
 from utils import config
 
+if TYPE_CHECKING:
+    from gcal import GCal
 
-def override_sections(sections):
-    overrides = config['COURSES'].get('overrides')
+
+def override_sections(sections, overrides=None):
+    if overrides is None:
+        overrides = config['COURSES'].get('overrides')
     if not overrides:
         return sections
     for course_code, course_sections in overrides.items():
@@ -30,29 +36,53 @@ def override_sections(sections):
     return sections
 
 
-def enrol_cms(course_code, sections):
-    enrolled = cms.get_enrolled_courses()
-    for sec_code in sections:
-        if any(course_code in c['fullname'] and sec_code in c['fullname']
-               for c in enrolled):
-            print("Already enrolled to", course_code, sec_code)
-            continue
-        print("Enrolling to", course_code, sec_code)
-        section = cms.search_course(f"{course_code} {sec_code}")
-        if not section:
-            print("Not found.")
-            continue
-        resp = cms.enrol(section['id'])
-        if resp.get('status') not in (True, 'true'):
-            print("error while enrolling")
+def enrol_cms(sections, client: cms.CMSClient, resolver: cms.CourseResolver):
+    to_enrol = []
+    for course_code, course_sections in sections.items():
+        for sec_code in sorted(course_sections):
+            course_id = resolver.resolve(course_code, sec_code)
+            if not course_id:
+                print("Not found:", course_code, sec_code)
+            elif course_id in client.enrolled_ids:
+                print("Already enrolled to", course_code, sec_code)
+            else:
+                to_enrol.append((course_code, sec_code, course_id))
+
+    responses = client.enrol_many(course_id for *_, course_id in to_enrol)
+    for (course_code, sec_code, _), resp in zip(to_enrol, responses):
+        if isinstance(resp, dict) and resp.get('status') in (True, 'true'):
+            print("Enrolled to", course_code, sec_code)
+        else:
+            print("error while enrolling to", course_code, sec_code)
             print(resp)
 
 
-def set_cal(gcal: GCal, cal_name, clear_old=True):
+def set_cal(gcal: 'GCal', cal_name, clear_old=True, recreate=False):
     print("Creating calendar for", cal_name)
     if gcal.set_cal(cal_name) and clear_old:
-        print("Calendar", cal_name, "already exists. Clearing old events.")
-        gcal.clear_cal()
+        if recreate:
+            print("Calendar", cal_name, "already exists. Recreating it.")
+        else:
+            print("Calendar", cal_name, "already exists. Clearing old events.")
+        gcal.clear_cal(recreate)
+
+
+def create_events(gcal: 'GCal', events):
+    created, failed = gcal.create_events(events)
+    for event, _ in created:
+        gcal.print_event(event, "Created", "in GCal.")
+    for event, error in failed:
+        gcal.print_event(event, "Failed to create", f"in GCal: {error}")
+
+
+def sync_events(gcal: 'GCal', events):
+    done, failed = gcal.sync_events(events)
+    for action, event in done:
+        gcal.print_event(event, action, "in GCal.")
+    for action, event, error in failed:
+        gcal.print_event(event, "Failed to sync", f"({action}) in GCal: {error}")
+    if not done and not failed:
+        print("Calendar is already up to date.")
 
 
 def get_cal_name():
@@ -60,10 +90,28 @@ def get_cal_name():
     return f"Timetable Sem {cur_sem}, {acad_year}-{acad_year + 1 - 2000}"
 
 
+def parse_args(parser: argparse.ArgumentParser):
+    """Parse the args, along with the flags of the Google sign-in if GCal is used.
+
+    The Google libraries are slow to import, so they aren't for CMS or ICS runs.
+    """
+    args, extra = parser.parse_known_args()
+    if args.only_cms or args.sink != 'gcal':
+        if extra:
+            parser.error(f"unrecognized arguments: {' '.join(extra)}")
+        return args
+    from gcal import tools
+    parser = argparse.ArgumentParser(
+        parents=[parser, tools.argparser], add_help=False,
+        formatter_class=parser.formatter_class)
+    return parser.parse_args()
+
+
 def main():
     parser = argparse.ArgumentParser(
-        parents=[tools.argparser],
-        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        epilog="With the gcal sink, the flags of the Google sign-in "
+               "(like --noauth_local_webserver) are accepted too.")
     parser.add_argument(
         '-n', '--new-creds',
         action='store_true', default=False,
@@ -76,9 +124,29 @@ def main():
         '--no-clear-old',
         action='store_true', default=False,
         help="Don't delete the calendar if it exists")
+    parser.add_argument(
+        '--recreate-cal',
+        action='store_true', default=False,
+        help="Delete and recreate the calendar instead of clearing its events")
+    parser.add_argument(
+        '--sync',
+        action='store_true', default=False,
+        help="Only insert, update or delete the events that have changed")
+    parser.add_argument(
+        '--max-age',
+        type=float, default=None, metavar='MINUTES',
+        help="Reuse the courses fetched from ERP in the last MINUTES minutes")
+    parser.add_argument(
+        '--sink',
+        choices=('gcal', 'ics'), default='gcal',
+        help="Create the events in Google Calendar, or write them to an .ics file")
+    parser.add_argument(
+        '--ics-file',
+        default=None,
+        help="Path of the .ics file (default: <title>.ics)")
     parser.add_argument(
         '--events',
-        nargs='+', default='all',
+        nargs='+', default=['All'],
         choices=list(EventType.__members__.keys()))
     cms_group = parser.add_mutually_exclusive_group()
     cms_group.add_argument(
@@ -89,25 +157,42 @@ def main():
         '-o', '--only-cms',
         action='store_true', default=False,
         help="Only enrol to CMS courses")
-    args = parser.parse_args()
+    args = parse_args(parser)
     args.events = reduce(ior, (getattr(EventType, event) for event in args.events))
 
-    if not args.only_cms:
+    if not args.only_cms and args.sink == 'gcal':
+        from gcal import GCal
         gcal = GCal(args.new_creds)
-        set_cal(gcal, args.title)
+        set_cal(gcal, args.title, not (args.no_clear_old or args.sync),
+                args.recreate_cal)
 
-    reg_sections = erp.get_reg_sections()
+    max_age = args.max_age and args.max_age * 60
+    reg_sections, changed = erp.get_reg_sections(max_age=max_age)
     print("Fetched registered courses from ERP.")
+    if changed:
+        print("Changed courses:", ", ".join(sorted(changed)))
     final_secions = override_sections(reg_sections)
 
+    if not args.skip_cms:
+        cms_client = cms.CMSClient()
+        enrol_cms(final_secions, cms_client, cms.CourseResolver(cms_client))
+
+    events = []
     for course_code, sections in final_secions.items():
-        course = get_course(course_code, sections)
-        if not args.skip_cms:
-            enrol_cms(course_code, sections)
+        course = coalesce_course(get_course(course_code, sections))
         if not args.only_cms:
-            for event in make_course_events(course, args.events):
-                gcal.create_event(event)
-                gcal.print_event(event, "Created", "in GCal.")
+            events.extend(make_course_events(course, args.events))
+
+    if args.only_cms:
+        return
+    if args.sink == 'ics':
+        ics_file = args.ics_file or f"{args.title}.ics"
+        count = write_calendar(ics_file, events, args.title)
+        print(f"Wrote {count} events to {ics_file}.")
+    elif args.sync:
+        sync_events(gcal, events)
+    else:
+        create_events(gcal, events)
 
 
 if __name__ == '__main__':
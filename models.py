@@ -0,0 +1,144 @@
+"""Compact types for the courses in the timetable.
+
+The same types are used for the raw timetable in CourseDB and for the
+courses placed on the calendar by timetable.get_course. The hours and
+weekdays are small ints, and the repeated strings are interned.
+"""
+from sys import intern
+
+DAYS = ('M', 'T', 'W', 'Th', 'F', 'S', 'Su')
+
+
+def to_wday_mask(isoweekdays):
+    """Bitmask of the ISO weekdays, with Monday as the lowest bit"""
+    mask = 0
+    for wday in isoweekdays:
+        mask |= 1 << (wday - 1)
+    return mask
+
+
+def iter_wdays(mask):
+    """ISO weekdays in the bitmask, in order"""
+    return (wday for wday in range(1, 8) if mask & (1 << (wday - 1)))
+
+
+def has_wday(mask, isoweekday):
+    return bool(mask & (1 << (isoweekday - 1)))
+
+
+class Record:
+    """Base class with positional fields in the order of __slots__"""
+
+    __slots__ = ()
+
+    def __init__(self, *args, **kwargs):
+        if kwargs or len(args) < len(self.__slots__):
+            args += tuple(kwargs.get(name) for name in self.__slots__[len(args):])
+        for name, value in zip(self.__slots__, args):
+            setattr(self, name, value)
+
+    def __reduce__(self):
+        return self.__class__, tuple(getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.__reduce__() == other.__reduce__()
+
+    def __repr__(self):
+        fields = ', '.join(f'{name}={getattr(self, name)!r}' for name in self.__slots__)
+        return f'{self.__class__.__name__}({fields})'
+
+
+class Sched(Record):
+    """Weekly class of a section in the timetable.
+
+    `wdays` is a bitmask of ISO weekdays and the hours are the timetable's
+    hour numbers, where hour 1 starts at 8 AM.
+    """
+
+    __slots__ = ('room', 'wdays', 'first_hour', 'last_hour')
+
+    @classmethod
+    def from_dict(cls, data):
+        wdays = to_wday_mask(DAYS.index(day) + 1 for day in data['days'])
+        hours = data['hours']
+        return cls(intern(data.get('room') or ''), wdays, hours[0], hours[-1])
+
+    def to_dict(self):
+        return {
+            'room': self.room,
+            'days': [DAYS[wday - 1] for wday in iter_wdays(self.wdays)],
+            'hours': list(range(self.first_hour, self.last_hour + 1)),
+        }
+
+
+class Meeting(Record):
+    """Sched placed on the calendar, with the start and end of its first class"""
+
+    __slots__ = ('room', 'wdays', 'start', 'end')
+
+
+class Section(Record):
+    """Section of a course, whose `sched` contains Sched or Meeting objects"""
+
+    __slots__ = ('num', 'instructors', 'sched')
+
+    @classmethod
+    def from_dict(cls, num, data):
+        return cls(
+            intern(num),
+            tuple(map(intern, data['instructors'])),
+            tuple(map(Sched.from_dict, data['sched'])),
+        )
+
+    def to_dict(self):
+        return {
+            'instructors': list(self.instructors),
+            'sched': [sched.to_dict() for sched in self.sched],
+        }
+
+
+class Exam(Record):
+    """Exam as written in the timetable. For compre, `time` is the session"""
+
+    __slots__ = ('date', 'time')
+
+
+class Timing(Record):
+    """Exam placed on the calendar"""
+
+    __slots__ = ('start', 'end')
+
+
+class Course(Record):
+    """Course in the timetable.
+
+    In CourseDB, `sections` is a dict of all the Sections by their number and
+    the exams are Exam objects. The courses returned by timetable.get_course
+    have a tuple of the selected Sections and Timing objects instead.
+    """
+
+    __slots__ = ('code', 'name', 'sections', 'midsem', 'compre')
+
+    @classmethod
+    def from_dict(cls, code, data):
+        midsem, compre = data.get('midsem'), data.get('compre')
+        return cls(
+            code,
+            data['name'],
+            {num: Section.from_dict(num, section)
+             for num, section in data['sections'].items()},
+            midsem and Exam(midsem['date'], midsem['time']),
+            compre and Exam(compre['date'], compre['session']),
+        )
+
+    def to_dict(self):
+        data = {
+            'name': self.name,
+            'sections': {num: section.to_dict()
+                         for num, section in self.sections.items()},
+        }
+        if self.compre:
+            data['compre'] = {'date': self.compre.date, 'session': self.compre.time}
+        if self.midsem:
+            data['midsem'] = {'date': self.midsem.date, 'time': self.midsem.time}
+        return data
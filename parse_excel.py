@@ -1,37 +1,211 @@
+import argparse
+import hashlib
+import mmap
+import os
+import pickle
+import posixpath
+import struct
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from pathlib import Path
+from xml.etree.ElementTree import iterparse, parse
 
-from openpyxl import load_workbook
-from utils import config, read_json, to_title, write_json
+from models import Course
+from utils import config, get_cache_path, read_json, to_title, write_json
 
+NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+REL_NS = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+PKG_REL_NS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+HEADER_ROWS = 2
 
-def iter_rows(wb, column_map):
-    """Generator for all the rows in the workbook"""
-    for sheet in wb:
-        rows = sheet.rows
-        next(rows)
-        next(rows)
-        for row in rows:
-            if not row:
+
+def col_index(cell_ref):
+    """Get 0 indexed column from the cell reference, like 'AB12'"""
+    index = 0
+    for char in cell_ref:
+        if char.isdigit():
+            break
+        index = index * 26 + ord(char) - 64
+    return index - 1
+
+
+def cast_number(value):
+    """Same conversion as openpyxl's"""
+    if "." in value or "E" in value or "e" in value:
+        return float(value)
+    return int(value)
+
+
+def read_shared_strings(xlsx: zipfile.ZipFile):
+    try:
+        f = xlsx.open("xl/sharedStrings.xml")
+    except KeyError:
+        return []
+    strings = []
+    with f:
+        for _, elem in iterparse(f):
+            if elem.tag == NS + "si":
+                text = elem.findtext(NS + "t")
+                if text is None:  # rich text
+                    runs = elem.iter(NS + "r")
+                    text = "".join(run.findtext(NS + "t", "") for run in runs)
+                strings.append(text)
+                elem.clear()
+    return strings
+
+
+def get_sheet_paths(xlsx: zipfile.ZipFile):
+    """Get the paths of the sheet XML files, in the order of the workbook"""
+    with xlsx.open("xl/_rels/workbook.xml.rels") as f:
+        rels = parse(f).iter(PKG_REL_NS + "Relationship")
+        targets = {rel.get("Id"): rel.get("Target") for rel in rels}
+    with xlsx.open("xl/workbook.xml") as f:
+        sheets = parse(f).iter(NS + "sheet")
+        paths = [targets[sheet.get(REL_NS + "id")] for sheet in sheets]
+    return [
+        path.lstrip("/") if path.startswith("/") else posixpath.join("xl", path)
+        for path in paths
+    ]
+
+
+def read_sheet_rows(xlsx: zipfile.ZipFile, sheet_path, shared_strings):
+    """Stream the cell values of the sheet's rows straight out of its XML.
+
+    Unlike openpyxl, numbers formatted as dates are not converted to datetime.
+    """
+    with xlsx.open(sheet_path) as f:
+        row_num = 0
+        for _, elem in iterparse(f):
+            if elem.tag != NS + "row":
                 continue
-            yield {name: row[col].value for name, col in column_map.items()}
+            row_num = int(elem.get("r", row_num + 1))
+            values = []
+            for cell in elem:
+                ref = cell.get("r")
+                if ref:
+                    values.extend([None] * (col_index(ref) - len(values)))
+                cell_type = cell.get("t", "n")
+                value = cell.findtext(NS + "v") or None
+                if cell_type == "inlineStr":
+                    inline = cell.find(NS + "is")
+                    value = None if inline is None else "".join(inline.itertext())
+                elif value is None:
+                    pass
+                elif cell_type == "s":
+                    value = shared_strings[int(value)]
+                elif cell_type == "n":
+                    value = cast_number(value)
+                elif cell_type == "b":
+                    value = value == "1"
+                values.append(value)
+            elem.clear()
+            yield row_num, values
 
 
-def parse_main_tt(file_path: Path):
-    COLUMNS = {  # 0 indexed column indices
-        "c_num": 1,
-        "c_title": 2,
-        "sec_num": 6,
-        "instr_name": 7,
-        "days": 8,
-        "hours": 9,
-        "midsem": 10,
-        "compre": 11,
-    }
-    workbook = load_workbook(file_path, read_only=True)
-    course_db = {}
-    for data in iter_rows(workbook, COLUMNS):
+def iter_xlsx_rows(file_path: Path, sheets=None):
+    """Generator for the values of all the rows in the workbook, except headers.
+
+    Reads the XML of the sheets directly, without any of openpyxl's overhead.
+    Only the sheets at the given indices are read, if specified.
+    Errors about missing parts of the file are raised right away.
+    """
+    xlsx = zipfile.ZipFile(file_path)
+    try:
+        shared_strings = read_shared_strings(xlsx)
+        sheet_paths = get_sheet_paths(xlsx)
+    except KeyError:
+        xlsx.close()
+        raise
+    if sheets is not None:
+        sheet_paths = [sheet_paths[index] for index in sheets]
+
+    def rows():
+        with xlsx:
+            for sheet_path in sheet_paths:
+                sheet_rows = read_sheet_rows(xlsx, sheet_path, shared_strings)
+                for row_num, values in sheet_rows:
+                    if row_num > HEADER_ROWS:
+                        yield values
+
+    return rows()
+
+
+def open_workbook(file_path: Path):
+    from openpyxl import load_workbook  # slow to import, and rarely needed
+
+    return load_workbook(file_path, read_only=True)
+
+
+def iter_openpyxl_rows(file_path: Path, sheets=None):
+    """Slower, but more lenient version of iter_xlsx_rows"""
+    worksheets = open_workbook(file_path).worksheets
+    if sheets is not None:
+        worksheets = [worksheets[index] for index in sheets]
+    for sheet in worksheets:
+        yield from sheet.iter_rows(min_row=HEADER_ROWS + 1, values_only=True)
+
+
+def iter_rows(file_path: Path, column_map, sheets=None):
+    """Generator for all the rows in the workbook"""
+    try:
+        rows = iter_xlsx_rows(file_path, sheets)
+    except KeyError as e:
+        print(f"Unexpected layout of {file_path} ({e}), reading it with openpyxl.")
+        rows = iter_openpyxl_rows(file_path, sheets)
+    for row in rows:
+        if not row:
+            continue
+        yield {name: row[col] if col < len(row) else None
+               for name, col in column_map.items()}
+
+
+def count_sheets(file_path: Path):
+    try:
+        with zipfile.ZipFile(file_path) as xlsx:
+            return len(get_sheet_paths(xlsx))
+    except KeyError:
+        return len(open_workbook(file_path).worksheets)
+
+
+MAIN_TT_COLUMNS = {  # 0 indexed column indices
+    "c_num": 1,
+    "c_title": 2,
+    "sec_num": 6,
+    "instr_name": 7,
+    "days": 8,
+    "hours": 9,
+    "midsem": 10,
+    "compre": 11,
+}
+
+
+class MainTTParser:
+    """Builds the course_db from the rows of the main timetable, one at a time.
+
+    The state carried from row to row is kept in the attributes, so that a
+    parser can be resumed from where another one left off.
+    """
+
+    def __init__(self):
+        self.course_db = {}
+        self.course = None
+        self.sec_type = None
+        self.sec_num_counter = None
+        self.section = None
+        self.instructors = None
+
+    def get_state(self):
+        return (self.course, self.sec_type, self.sec_num_counter,
+                self.section, self.instructors)
+
+    def set_state(self, state):
+        (self.course, self.sec_type, self.sec_num_counter,
+         self.section, self.instructors) = state
+
+    def feed(self, data):
         if not data["instr_name"]:
-            continue  # blank row
+            return  # blank row
         # new Course
         if data["c_num"]:
             course = {
@@ -44,28 +218,30 @@ def parse_main_tt(file_path: Path):
             if data["midsem"]:
                 date, time = data["midsem"].split("\n")
                 course["midsem"] = {"date": date.strip(), "time": time.strip()}
-            course_db[data["c_num"]] = course  # add to course
-            sec_type = "L"
-            sec_num_counter = 1
+            self.course_db[data["c_num"]] = course  # add to course
+            self.course = course
+            self.sec_type = "L"
+            self.sec_num_counter = 1
 
         # new Tutorial or Practical section
         if not data["c_num"] and data["c_title"]:
-            sec_type = data["c_title"][0]
-            sec_num_counter = 1
+            self.sec_type = data["c_title"][0]
+            self.sec_num_counter = 1
 
         # new Section
         if (
             data["instr_name"]
             and data.get("room", True)
-            and not sec_type == "L"
+            and not self.sec_type == "L"
             or data["sec_num"]
         ) or data["c_title"]:
-            sec_num = int(data["sec_num"] or sec_num_counter)
-            section = {"instructors": [], "sched": []}
-            course["sections"][sec_type + str(sec_num)] = section
-            sec_num_counter += 1
-            instructors = set()  # keep track of unique instructors
+            sec_num = int(data["sec_num"] or self.sec_num_counter)
+            self.section = {"instructors": [], "sched": []}
+            self.course["sections"][self.sec_type + str(sec_num)] = self.section
+            self.sec_num_counter += 1
+            self.instructors = set()  # keep track of unique instructors
 
+        section = self.section
         if isinstance(data.get("hours"), (float, int)):
             data["hours"] = str(int(data["hours"]))
         if data.get("days"):
@@ -82,17 +258,75 @@ def parse_main_tt(file_path: Path):
             else:
                 for hour in hours:  # separate sched for each hour
                     section["sched"].append(dict(**sched, hours=(hour,)))
-        if data["instr_name"].lower() not in instructors:
+        if data["instr_name"].lower() not in self.instructors:
             section["instructors"].append(data["instr_name"])
-            instructors.add(data["instr_name"].lower())
-    return course_db
+            self.instructors.add(data["instr_name"].lower())
+
+
+def parse_main_tt(file_path: Path):
+    parser = MainTTParser()
+    for data in iter_rows(file_path, MAIN_TT_COLUMNS):
+        parser.feed(data)
+    return parser.course_db
+
+
+def parse_sheets(file_path: Path, start, stop):
+    """Parse the courses which start in the sheets from start to stop.
+
+    Returns the leading rows which belong to the last course of the previous
+    sheet, the parsed courses and the final state of the parser.
+    """
+    rows = iter_rows(file_path, MAIN_TT_COLUMNS, range(start, stop))
+    leading = []
+    for data in rows:
+        if data["instr_name"] and data["c_num"]:
+            break
+        leading.append(data)
+    else:
+        return leading, {}, None
+    parser = MainTTParser()
+    parser.feed(data)
+    for data in rows:
+        parser.feed(data)
+    # pickled together, so the state still refers to the objects in course_db
+    return leading, parser.course_db, parser.get_state()
+
+
+def split_sheets(num_sheets, num_chunks):
+    """Split the sheet indices into contiguous (start, stop) ranges"""
+    num_chunks = max(1, min(num_chunks, num_sheets))
+    bounds = [num_sheets * i // num_chunks for i in range(num_chunks + 1)]
+    return list(zip(bounds, bounds[1:]))
+
+
+def parse_main_tt_parallel(file_path: Path, workers=None):
+    """Same as parse_main_tt, but the sheets are parsed in a process pool.
+
+    Each worker gets one contiguous run of sheets, so the workbook (and its
+    shared strings) is only read once per worker. The partial results are
+    merged in the order of the sheets, with the rows that continue a course
+    from a previous run replayed on top of them.
+    """
+    num_sheets = count_sheets(file_path)
+    chunks = split_sheets(num_sheets, workers or os.cpu_count() or 1)
+    if len(chunks) == 1:
+        return parse_main_tt(file_path)  # a pool would only add overhead
+    with ProcessPoolExecutor(workers) as executor:
+        pieces = executor.map(parse_sheets, repeat(file_path), *zip(*chunks))
+        parser = MainTTParser()
+        for leading, course_db, state in pieces:
+            for data in leading:
+                parser.feed(data)
+            parser.course_db.update(course_db)
+            if state:
+                parser.set_state(state)
+    return parser.course_db
 
 
 def parse_midsem(file_path: Path):
     COLUMNS = {"c_num": 1, "c_title": 2, "date": 3, "time": 4}
-    workbook = load_workbook(file_path, read_only=True)
     midsem = {}
-    for row in iter_rows(workbook, COLUMNS):
+    for row in iter_rows(file_path, COLUMNS):
         if "*" in row["time"]:
             continue
         c_dept, c_num = row["c_num"].strip().split()
@@ -103,48 +337,220 @@ def parse_midsem(file_path: Path):
     return midsem
 
 
-def parse_files(tt_file: Path, midsem_file: Path):
-    timetable = parse_main_tt(tt_file)
+def parse_files(tt_file: Path, midsem_file: Path, workers=1):
+    if workers == 1:
+        timetable = parse_main_tt(tt_file)
+    else:
+        timetable = parse_main_tt_parallel(tt_file, workers)
     if midsem_file.is_file():
         midsem = parse_midsem(midsem_file)
         for k, v in midsem.items():
             timetable[k]["midsem"] = v
     else:
         print(f"File '{midsem_file}' not found. Midsem details will not be added.")
-    return timetable
+    return to_models(timetable)
+
+
+def to_models(timetable: dict):
+    """Convert the courses from the parsed/JSON format to Course objects"""
+    return {code: Course.from_dict(code, course) for code, course in timetable.items()}
+
+
+def get_signature(path: Path, old=None):
+    """Size, mtime and content hash of the file.
+
+    The hash is reused from the old signature if the size and mtime match.
+    """
+    stat = path.stat()
+    signature = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+    if old and all(old.get(key) == value for key, value in signature.items()):
+        signature["sha256"] = old["sha256"]
+    else:
+        signature["sha256"] = hashlib.sha256(path.read_bytes()).hexdigest()
+    return signature
+
+
+def is_same_content(signatures, old_signatures):
+    return signatures.keys() == old_signatures.keys() and all(
+        sig["sha256"] == old_signatures[path]["sha256"]
+        for path, sig in signatures.items()
+    )
 
 
 class CourseDB:
+    """The parsed timetable, cached on disk in a compact binary format.
+
+    The cache is reused only if the contents of the source files haven't
+    changed since it was written. Each course is stored separately, along with
+    an index of their offsets, so that a course can be decoded without loading
+    the whole timetable.
+    """
+
+    CACHE_VERSION = 3
+    HEADER_LEN = struct.Struct("<Q")
     tt_file = Path(config["COURSES"]["tt_file"])
     midsem_file = Path(config["COURSES"].get("midsem_file", ""))
     _course_db = None
     _timetable = None
+    _cache = None
+    _courses = None
 
     def __new__(cls, *args, **kwargs):
         if not cls._course_db:
             cls._course_db = super().__new__(cls, *args, **kwargs)
         return cls._course_db
 
-    def get_timetable(self, force_parse=False):
+    @property
+    def cache_file(self):
+        return get_cache_path("course-db", self.tt_file.stem + ".pickle")
+
+    @property
+    def prev_cache_file(self):
+        """Cache of the previous revision of the timetable, kept for diffing"""
+        return get_cache_path("course-db", self.tt_file.stem + ".prev.pickle")
+
+    @property
+    def sources(self):
+        if self.tt_file.suffix == ".json" or not self.midsem_file.is_file():
+            return [self.tt_file]
+        return [self.tt_file, self.midsem_file]
+
+    def open_cache(self, path=None):
+        """Read the header of the cache and map the courses into memory"""
+        try:
+            f = open(path or self.cache_file, "rb")
+        except FileNotFoundError:
+            return None
+        with f:
+            try:
+                (header_len,) = self.HEADER_LEN.unpack(f.read(self.HEADER_LEN.size))
+                if header_len > os.fstat(f.fileno()).st_size:
+                    return None  # not written by this version
+                cache = pickle.loads(f.read(header_len))
+            except (struct.error, pickle.UnpicklingError, EOFError):
+                return None
+            if not isinstance(cache, dict) or cache.get("version") != self.CACHE_VERSION:
+                return None
+            cache["start"] = self.HEADER_LEN.size + header_len
+            cache["data"] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cache
+
+    def write_cache(self, signatures, timetable):
+        index, blobs, offset = {}, [], 0
+        for course_code, course in timetable.items():
+            blob = pickle.dumps(course, pickle.HIGHEST_PROTOCOL)
+            index[course_code] = (offset, len(blob))
+            blobs.append(blob)
+            offset += len(blob)
+        header = {
+            "version": self.CACHE_VERSION,
+            "sources": signatures,
+            "index": index,
+        }
+        header = pickle.dumps(header, pickle.HIGHEST_PROTOCOL)
+        tmp_file = self.cache_file.with_suffix(".tmp")
+        with open(tmp_file, "wb") as f:
+            f.write(self.HEADER_LEN.pack(len(header)))
+            f.write(header)
+            f.writelines(blobs)
+        os.replace(tmp_file, self.cache_file)  # don't disturb other readers
+
+    def close_cache(self):
+        """Unmap the cache. Windows can't replace the file while it is mapped."""
+        if self._cache is not None:
+            self._cache["data"].close()
+            self._cache = None
+
+    def load(self, force_parse=False, workers=1):
+        """Make sure that the cache is up to date, and open it"""
         if not self.tt_file.exists():
             raise FileNotFoundError(self.tt_file)
-        json_file = self.tt_file.with_suffix(".json")
-        if not json_file.exists() or (force_parse and self.tt_file.suffix != '.json'):
-            self._timetable = parse_files(self.tt_file, self.midsem_file)
-            write_json(json_file, self._timetable)
+        self.close_cache()
+        cache = self.open_cache()
+        old_signatures = cache["sources"] if cache else {}
+        signatures = {
+            str(path): get_signature(path, old_signatures.get(str(path)))
+            for path in self.sources
+        }
+        self._courses = {}
+        if cache and not force_parse and is_same_content(signatures, old_signatures):
+            self._cache = cache
+            self._timetable = None
+            if signatures != old_signatures:  # only the mtimes changed
+                timetable = self.timetable  # decoded before the file is unmapped
+                self.close_cache()
+                self.write_cache(signatures, timetable)
+                self._cache = self.open_cache()
+            return
+        if self.tt_file.suffix == ".json":
+            self._timetable = to_models(read_json(self.tt_file))
         else:
-            self._timetable = read_json(json_file)
-        return self._timetable
+            self._timetable = parse_files(self.tt_file, self.midsem_file, workers)
+        if cache:
+            cache["data"].close()
+            if not is_same_content(signatures, old_signatures):
+                os.replace(self.cache_file, self.prev_cache_file)  # a new revision
+        self.write_cache(signatures, self._timetable)
+        self._cache = self.open_cache()
+
+    def read_snapshot(self, path):
+        """Decode all the courses of a cache file written by any CourseDB.
+
+        Returns None if the file doesn't exist or is in an old format.
+        """
+        cache = self.open_cache(path)
+        if not cache:
+            return None
+        data, start = cache["data"], cache["start"]
+        with data:
+            return {
+                course_code: pickle.loads(data[start + offset:start + offset + size])
+                for course_code, (offset, size) in cache["index"].items()
+            }
+
+    def get_timetable(self, force_parse=False, workers=1):
+        self.load(force_parse, workers)
+        return self.timetable
+
+    def export_json(self):
+        json_file = self.tt_file.with_suffix(".json")
+        write_json(json_file, {code: course.to_dict()
+                               for code, course in self.timetable.items()})
+        return json_file
+
+    def fingerprint(self):
+        """Hash of the contents of the timetable files the courses are parsed from"""
+        if self._cache is None:
+            self.load()
+        digest = hashlib.sha256(str(self.CACHE_VERSION).encode())
+        for signature in self._cache["sources"].values():
+            digest.update(signature["sha256"].encode())
+        return digest.hexdigest()
+
+    def codes(self):
+        if self._cache is None:
+            self.load()
+        return self._cache["index"].keys()
 
     def __getitem__(self, course_code):
-        if not self._timetable:
-            self._timetable = self.get_timetable()
-        return self._timetable.get(course_code)
+        if self._timetable is not None:
+            return self._timetable.get(course_code)
+        if self._cache is None:
+            self.load()
+        if course_code not in self._courses:
+            entry = self._cache["index"].get(course_code)
+            if entry is None:
+                return None
+            start = self._cache["start"] + entry[0]
+            course = pickle.loads(self._cache["data"][start:start + entry[1]])
+            self._courses[course_code] = course
+        return self._courses[course_code]
 
     @property
     def timetable(self):
-        if not self._timetable:
-            self._timetable = self.get_timetable()
+        if self._timetable is None:
+            self._timetable = {course_code: self[course_code]
+                               for course_code in self.codes()}
         return self._timetable
 
 
@@ -152,7 +558,31 @@ course_db = CourseDB()
 
 
 def main():
-    CourseDB().get_timetable(True)
+    parser = argparse.ArgumentParser(description="Parse the timetable excel files")
+    parser.add_argument(
+        "-j", "--workers",
+        type=int, default=1,
+        help="Number of processes to parse the sheets in (0 for one per CPU)",
+    )
+    parser.add_argument(
+        "--json",
+        action="store_true", default=False,
+        help="Also export the parsed timetable as JSON, next to the excel file",
+    )
+    parser.add_argument(
+        "--validate",
+        action="store_true", default=False,
+        help="Check that all the parsed courses can be converted to events",
+    )
+    args = parser.parse_args()
+    course_db.get_timetable(True, args.workers or None)
+    if args.validate:
+        from timetable import validate_db  # imports this module
+
+        if validate_db(args.workers or None):
+            exit(1)
+    if args.json and course_db.tt_file.suffix != ".json":
+        print("Exported timetable to", course_db.export_json())
 
 
 if __name__ == "__main__":
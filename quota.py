@@ -0,0 +1,243 @@
+"""Scheduler for the Google Calendar API requests, which keeps within the quota.
+
+Every request first takes a token from a token bucket, which limits the rate of
+the requests, and then a slot from a semaphore, which limits how many are in
+flight. Requests which fail because of the rate limits (429, or 403 with a rate
+limit reason) are retried with exponential backoff and jitter, waiting for at
+least the `Retry-After` of the response. So are the idempotent requests which
+fail with a server error. An insert is not retried then, since it might have
+been done anyway, and retrying it would duplicate the event.
+
+The limits are read from the optional `[GCAL]` table of the config.
+"""
+import json
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+from googleapiclient.errors import HttpError
+from utils import config
+
+QUOTA = config.get("GCAL", {})
+RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded", "quotaExceeded"}
+SERVER_ERRORS = {500, 502, 503, 504}
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "PATCH", "DELETE"}
+
+
+def get_reason(error: HttpError):
+    try:
+        return json.loads(error.content)["error"]["errors"][0]["reason"]
+    except (ValueError, KeyError, IndexError, TypeError):
+        return None
+
+
+def is_rate_limited(error: HttpError):
+    status = error.resp.status
+    return status == 429 or status == 403 and get_reason(error) in RATE_LIMIT_REASONS
+
+
+def is_idempotent(request):
+    return request.method.upper() in IDEMPOTENT_METHODS
+
+
+def is_retryable(error: HttpError, idempotent=True):
+    """Throttled requests weren't done, but the failed ones might have been"""
+    if is_rate_limited(error):
+        return True
+    return idempotent and error.resp.status in SERVER_ERRORS
+
+
+def get_retry_after(error: HttpError):
+    """Seconds to wait as asked by the Retry-After header, if any"""
+    value = error.resp.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """Allows `rate` requests per second on average, and bursts of `capacity`"""
+
+    def __init__(self, rate, capacity, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.updated = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens=1):
+        """Take the tokens, and return how long to wait before using them"""
+        with self._lock:
+            now = self.clock()
+            elapsed = now - self.updated
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated = now
+            self.tokens -= tokens  # may go negative, to queue up the callers
+            return max(0.0, -self.tokens / self.rate)
+
+    def acquire(self, tokens=1):
+        wait = self.reserve(tokens)
+        if wait:
+            self.sleep(wait)
+        return wait
+
+
+class Metrics:
+    """Counters of the scheduler, safe to update from many threads"""
+
+    FIELDS = (
+        "requests",
+        "queued",
+        "max_queued",
+        "throttled",
+        "retried",
+        "failed",
+        "wait_time",
+    )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = dict.fromkeys(self.FIELDS, 0)
+
+    def add(self, name, value=1):
+        with self._lock:
+            self._values[name] += value
+            if name == "queued":
+                self._values["max_queued"] = max(
+                    self._values["max_queued"], self._values["queued"]
+                )
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    def __str__(self):
+        values = self.snapshot()
+        values["wait_time"] = f"{values['wait_time']:.1f}s"
+        return ", ".join(f"{name}={value}" for name, value in values.items())
+
+
+class RequestScheduler:
+    """Runs the API requests within the rate and concurrency limits, with retries.
+
+    It can be shared by many GCal objects, like the ones of all the students in
+    bulk mode, since the quota is per project.
+    """
+
+    def __init__(
+        self,
+        rate=QUOTA.get("requests_per_second", 10),
+        burst=QUOTA.get("burst", 20),
+        max_concurrency=QUOTA.get("max_concurrency", 4),
+        max_retries=QUOTA.get("max_retries", 5),
+        base_delay=1.0,
+        max_delay=64.0,
+        sleep=time.sleep,
+        clock=time.monotonic,
+    ):
+        self.bucket = TokenBucket(rate, burst, clock, sleep)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sleep = sleep
+        self.metrics = Metrics()
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+
+    def get_delay(self, attempt, errors=()):
+        """Exponential backoff with full jitter, but no less than any Retry-After"""
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        retry_after = [get_retry_after(error) for error in errors]
+        return max([delay, *filter(None, retry_after)])
+
+    def run(self, func, cost=1):
+        """Call func once its turn comes, within the limits"""
+        self.metrics.add("queued")
+        try:
+            wait = self.bucket.acquire(cost)
+            self._slots.acquire()
+        finally:
+            self.metrics.add("queued", -1)
+        try:
+            self.metrics.add("wait_time", wait)
+            self.metrics.add("requests", cost)
+            return func()
+        finally:
+            self._slots.release()
+
+    def backoff(self, attempt, errors):
+        self.metrics.add("throttled", sum(map(is_rate_limited, errors)))
+        if attempt >= self.max_retries:
+            return False
+        delay = self.get_delay(attempt, errors)
+        self.metrics.add("retried", len(errors))
+        self.metrics.add("wait_time", delay)
+        self.sleep(delay)
+        return True
+
+    def execute(self, request, **kwargs):
+        """Execute the API request, retrying it if it is throttled"""
+        attempt = 0
+        while True:
+            try:
+                return self.run(lambda: request.execute(**kwargs))
+            except HttpError as error:
+                retryable = is_retryable(error, is_idempotent(request))
+                if not retryable or not self.backoff(attempt, [error]):
+                    self.metrics.add("failed")
+                    raise
+            attempt += 1
+
+    def execute_batch(self, make_batch, requests, **kwargs):
+        """Execute the (id, request) pairs in a batch, retrying the throttled ones.
+
+        `make_batch(callback)` should return a new batch request. Returns the
+        responses and the errors, as maps of the request ids to them.
+        """
+        pending = dict(requests)
+        responses, errors = {}, {}
+        attempt = 0
+        while pending:
+            retry = {}
+
+            def callback(request_id, response, exception):
+                if exception is None:
+                    responses[request_id] = response
+                elif isinstance(exception, HttpError) and is_retryable(
+                    exception, is_idempotent(pending[request_id])
+                ):
+                    retry[request_id] = exception
+                else:
+                    errors[request_id] = exception
+
+            batch = make_batch(callback)
+            for request_id, request in pending.items():
+                batch.add(request, request_id=request_id)
+            try:
+                self.run(lambda: batch.execute(**kwargs), cost=len(pending))
+            except HttpError as error:  # the whole batch failed
+                if not is_retryable(error):
+                    raise
+                for request_id, request in pending.items():
+                    if is_retryable(error, is_idempotent(request)):
+                        retry[request_id] = error
+                    else:
+                        errors[request_id] = error
+            if not retry:
+                break
+            if not self.backoff(attempt, list(retry.values())):
+                errors.update(retry)
+                self.metrics.add("failed", len(retry))
+                break
+            pending = {request_id: pending[request_id] for request_id in retry}
+            attempt += 1
+        return responses, errors
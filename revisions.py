@@ -0,0 +1,191 @@
+"""Differences between two revisions of the timetable.
+
+When a corrected timetable is published, CourseDB keeps the cache of the
+previous revision next to the new one. The changes between the two are mapped
+to the registered sections of each student and to the events made for them,
+so that only the affected students and events need to be synced again.
+
+Usage: python revisions.py [OLD] [NEW]
+OLD and NEW can be CourseDB caches (.pickle) or timetable files (.json/.xlsx),
+and default to the previous and the current revision of the timetable.
+"""
+import argparse
+from pathlib import Path
+
+from coalesce import coalesce_meetings
+from events import get_exam_key, get_section_key
+from models import DAYS, Record, iter_wdays
+from parse_excel import course_db, parse_files, to_models
+from timetable import find_section, parse_section
+from utils import read_json
+
+COURSE_ADDED = 'course added'
+COURSE_REMOVED = 'course removed'
+NAME = 'name'
+SECTION_ADDED = 'section added'
+SECTION_REMOVED = 'section removed'
+INSTRUCTORS = 'instructors'
+ROOM = 'room'
+TIME = 'time'
+MIDSEM = 'midsem'
+COMPRE = 'compre'
+
+
+class Change(Record):
+    """Change in a course. `section` is None for the changes of the whole course"""
+
+    __slots__ = ('code', 'kind', 'section', 'old', 'new')
+
+    def __str__(self):
+        where = f'{self.code} {self.section}' if self.section else self.code
+        if self.kind in (COURSE_ADDED, SECTION_ADDED, COURSE_REMOVED, SECTION_REMOVED):
+            return f'{where}: {self.kind}'
+        return f'{where}: {self.kind} {describe(self.old)} -> {describe(self.new)}'
+
+
+def describe(value):
+    if value is None or value == '':
+        return '-'
+    if isinstance(value, tuple):
+        return '; '.join(map(describe, value))
+    if hasattr(value, 'first_hour'):  # Sched
+        days = ' '.join(DAYS[wday - 1] for wday in iter_wdays(value.wdays))
+        hours = f'{value.first_hour}-{value.last_hour}'
+        return f'{days} {hours} {value.room}'.strip()
+    if hasattr(value, 'date'):  # Exam
+        return f'{value.date} {value.time}'
+    return str(value)
+
+
+def diff_sections(code, num, old, new):
+    if old is None:
+        yield Change(code, SECTION_ADDED, num, None, new)
+        return
+    if new is None:
+        yield Change(code, SECTION_REMOVED, num, old, None)
+        return
+    if old.instructors != new.instructors:
+        yield Change(code, INSTRUCTORS, num, ', '.join(old.instructors),
+                     ', '.join(new.instructors))
+    if len(old.sched) != len(new.sched):
+        yield Change(code, TIME, num, old.sched, new.sched)
+        return
+    for old_sched, new_sched in zip(old.sched, new.sched):
+        if old_sched.room != new_sched.room:
+            yield Change(code, ROOM, num, old_sched.room, new_sched.room)
+        old_time = (old_sched.wdays, old_sched.first_hour, old_sched.last_hour)
+        if old_time != (new_sched.wdays, new_sched.first_hour, new_sched.last_hour):
+            yield Change(code, TIME, num, old_sched, new_sched)
+
+
+def diff_courses(code, old, new):
+    if old is None:
+        yield Change(code, COURSE_ADDED, None, None, new)
+        return
+    if new is None:
+        yield Change(code, COURSE_REMOVED, None, old, None)
+        return
+    if old.name != new.name:
+        yield Change(code, NAME, None, old.name, new.name)
+    for num in sorted(old.sections.keys() | new.sections.keys()):
+        yield from diff_sections(code, num, old.sections.get(num), new.sections.get(num))
+    for kind in (MIDSEM, COMPRE):
+        old_exam, new_exam = getattr(old, kind), getattr(new, kind)
+        if old_exam != new_exam:
+            yield Change(code, kind, None, old_exam, new_exam)
+
+
+def diff_timetables(old, new):
+    """Get the changes between two revisions of the timetable"""
+    changes = []
+    for code in sorted(old.keys() | new.keys()):
+        old_course, new_course = old.get(code), new.get(code)
+        if old_course != new_course:
+            changes.extend(diff_courses(code, old_course, new_course))
+    return changes
+
+
+def get_event_keys(course, sections, change):
+    """Sync keys of the events of the course, made for the given sections,
+    which are affected by the change"""
+    if change.kind in (MIDSEM, COMPRE):
+        return {get_exam_key(change.code, change.kind.title())}
+    keys = set()
+    for sec_num in sections:
+        section = find_section(course.sections, sec_num)
+        if section and change.section in (None, section.num):
+            meetings = coalesce_meetings(parse_section(section, sec_num).sched)
+            keys.update(get_section_key(change.code, sec_num, index)
+                        for index in range(len(meetings)))
+    if change.section is None:  # all the events of the course
+        keys.update(get_exam_key(change.code, kind.title())
+                    for kind in (MIDSEM, COMPRE) if getattr(course, kind))
+    return keys
+
+
+def get_affected_events(changes, sections, old, new):
+    """Sync keys of the events of a student which are affected by the changes.
+
+    `sections` are the registered sections of the student (as returned by
+    erp.get_reg_sections), and `old` and `new` are the revisions of the
+    timetable. The keys from both the revisions are included, since the events
+    of the old one need to be deleted or updated.
+    """
+    keys = set()
+    for change in changes:
+        course_sections = sections.get(change.code)
+        if not course_sections:
+            continue
+        for course in (old.get(change.code), new.get(change.code)):
+            if course:
+                keys |= get_event_keys(course, course_sections, change)
+    return keys
+
+
+def get_affected_students(changes, students, old, new):
+    """Map of student to their affected events, for the students with any.
+
+    `students` is a map of each student to their registered sections.
+    """
+    affected = {}
+    for student, sections in students.items():
+        keys = get_affected_events(changes, sections, old, new)
+        if keys:
+            affected[student] = keys
+    return affected
+
+
+def read_revision(path: Path):
+    if path.suffix == '.pickle':
+        timetable = course_db.read_snapshot(path)
+        if timetable is None:
+            print(f"Invalid timetable cache at {path}.")
+            quit()
+        return timetable
+    if path.suffix == '.json':
+        return to_models(read_json(path))
+    return parse_files(path, course_db.midsem_file)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Show the changes between two revisions of the timetable")
+    parser.add_argument('old', nargs='?', type=Path, default=course_db.prev_cache_file)
+    parser.add_argument('new', nargs='?', type=Path, default=None)
+    args = parser.parse_args()
+
+    # loaded first, since it moves the current revision to the previous one
+    new = read_revision(args.new) if args.new else course_db.get_timetable()
+    if not args.old.exists():
+        print("No previous revision of the timetable found at", args.old)
+        return
+    old = read_revision(args.old)
+    changes = diff_timetables(old, new)
+    for change in changes:
+        print(change)
+    courses = len({change.code for change in changes})
+    print(f"{len(changes)} changes in {courses} courses.")
+
+
+if __name__ == '__main__':
+    main()
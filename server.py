@@ -0,0 +1,227 @@
+"""HTTP service for the timetables of students, with all the caches kept warm.
+
+The timetable, the academic calendar and the events of every section are
+loaded once at startup, so a request only looks up the events of the sections.
+
+    POST /timetable.json  -> {"events": [<events, as sent to the Calendar API>]}
+    POST /timetable.ics   -> iCalendar file of the events
+
+The body of the request is a JSON object with either the registered sections,
+like {"sections": {"CS F111": ["L1", "T2"]}}, or the ERP credentials to fetch
+them from, like {"erp": {"username": "...", "password": "..."}}. It can also
+have the "overrides" of the sections (like in config.toml), the "events" types
+(default ["All"]) and the "title" of the calendar.
+
+The same can be requested with GET, for calendar apps which subscribe to the
+feed, with the sections in the query string, like
+    GET /timetable.ics?CS F111=L1,T2&MATH F211=L1&events=Lectures,Midsem
+
+The responses have an ETag, made from the hashes of the prebuilt iCalendar
+fragments of the sections, so the clients polling the feed get a 304 if
+it hasn't changed.
+
+With --fake-erp FILE, the sections of the ERP users are read from a JSON file
+of {username: {course code: [sections]}} instead, for testing without ERP.
+"""
+import argparse
+import asyncio
+import hashlib
+import logging
+from functools import reduce
+from operator import ior
+
+try:
+    from aiohttp import web
+except ImportError:
+    print("The server needs aiohttp. Install it with `poetry install -E server`.")
+    exit()
+
+from erp import (MAX_CONCURRENCY, ERPConnectionError, ERPLoginError, ERPPool,
+                 is_valid_username)
+from events import EventType
+from ics import CALENDAR_FOOTER, calendar_header
+from main import get_cal_name, override_sections
+from parse_excel import course_db
+from templates import EventTemplates
+from utils import read_json
+
+
+QUERY_PARAMS = ('events', 'title')
+logger = logging.getLogger(__name__)
+
+
+class BadRequest(Exception):
+    pass
+
+
+def get_etag(*parts, fragments):
+    digest = hashlib.sha1(repr(parts).encode())
+    for _, fragment_hash in fragments:
+        digest.update(fragment_hash.encode())
+    return digest.hexdigest()
+
+
+def is_str_list(value):
+    return isinstance(value, list) and all(isinstance(item, str) for item in value)
+
+
+def check_sections(sections):
+    """The sections of the request, as {course code: set of sections}"""
+    if not isinstance(sections, dict) or not all(map(is_str_list, sections.values())):
+        raise BadRequest("'sections' must map course codes to lists of sections")
+    return {code: set(secs) for code, secs in sections.items()}
+
+
+def check_overrides(overrides):
+    if not isinstance(overrides, dict) or not all(
+            isinstance(secs, dict)
+            and all(isinstance(sec, str) for item in secs.items() for sec in item)
+            for secs in overrides.values()):
+        raise BadRequest("'overrides' must map course codes to {old: new section}")
+    return overrides
+
+
+async def read_params(request):
+    """Parameters of the request, from the JSON body or the query string"""
+    if request.method == 'POST':
+        data = await request.json()
+        if not isinstance(data, dict):
+            raise BadRequest("The body must be a JSON object")
+        return data
+    query = request.query
+    data = {'sections': {code: sections.split(',') for code, sections in query.items()
+                         if code not in QUERY_PARAMS}}
+    if 'events' in query:
+        data['events'] = query['events'].split(',')
+    if 'title' in query:
+        data['title'] = query['title']
+    return data
+
+
+class TimetableService:
+    def __init__(self, fake_erp=None, max_age=None, erp_concurrency=MAX_CONCURRENCY):
+        self.fake_erp = fake_erp
+        self.max_age = max_age
+        self.erp_pool = ERPPool(erp_concurrency)
+        self.templates = EventTemplates()
+
+    def load(self):
+        course_db.load()
+        self.templates.load()
+
+    async def get_sections(self, data):
+        if 'sections' in data:
+            return check_sections(data['sections'])
+        creds = data.get('erp')
+        if not isinstance(creds, dict) or 'username' not in creds:
+            raise BadRequest("Either 'sections' or 'erp' credentials are needed")
+        if not is_valid_username(creds['username']):
+            raise BadRequest("Invalid ERP username")
+        if not isinstance(creds.get('password'), str):
+            raise BadRequest("The ERP password must be a string")
+        creds = {'username': creds['username'], 'password': creds['password']}
+        if self.fake_erp is not None:
+            sections = self.fake_erp.get(creds['username'])
+            if sections is None:
+                raise ERPLoginError(f"Unknown user {creds['username']}")
+            return {code: set(secs) for code, secs in sections.items()}
+        loop = asyncio.get_running_loop()
+        try:
+            sections, _ = await loop.run_in_executor(
+                None, self.erp_pool.get_reg_sections, creds, self.max_age)
+        except (ERPLoginError, ERPConnectionError):
+            raise
+        except Exception as e:  # like an unexpected page from ERP
+            logger.exception("Failed to get the sections of %s", creds['username'])
+            raise ERPConnectionError("Failed to get the sections from ERP") from e
+        return sections
+
+    def get_events(self, sections, event_types):
+        return [event
+                for course_code, course_sections in sorted(sections.items())
+                for event in self.templates.get(course_code, course_sections,
+                                                event_types)]
+
+    def get_fragments(self, sections, event_types):
+        return [fragment
+                for course_code, course_sections in sorted(sections.items())
+                for fragment in self.templates.get_fragments(
+                    course_code, course_sections, event_types)]
+
+    async def timetable(self, request):
+        try:
+            data = await read_params(request)
+            event_names = data.get('events', ['All'])
+            if not is_str_list(event_names) or not event_names:
+                raise BadRequest("'events' must be a list of event types")
+            event_types = reduce(ior, (EventType[name] for name in event_names))
+            title = data.get('title') or get_cal_name()
+            if not isinstance(title, str):
+                raise BadRequest("'title' must be a string")
+            overrides = check_overrides(data.get('overrides') or {})
+            sections = await self.get_sections(data)
+        except (ValueError, KeyError, TypeError, BadRequest) as e:
+            return web.json_response({'error': f"Invalid request: {e}"}, status=400)
+        except ERPLoginError as e:
+            return web.json_response({'error': str(e)}, status=401)
+        except ERPConnectionError as e:
+            return web.json_response({'error': str(e)}, status=502)
+
+        sections = override_sections(sections, overrides)
+        fragments = self.get_fragments(sections, event_types)
+        file_format = request.match_info['format']
+        etag = get_etag(file_format, title, self.templates.dtstamp, fragments=fragments)
+        headers = {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'}
+        if any(tag.value in (etag, '*') for tag in request.if_none_match or ()):
+            return web.Response(status=304, headers=headers)
+
+        if file_format == 'ics':
+            text = ''.join((calendar_header(title),
+                            *(fragment for fragment, _ in fragments), CALENDAR_FOOTER))
+            return web.Response(text=text, headers=headers,
+                                content_type='text/calendar', charset='utf-8')
+        events = self.get_events(sections, event_types)
+        return web.json_response({'events': events}, headers=headers)
+
+    async def health(self, request):
+        return web.json_response({'status': 'OK', 'courses': len(course_db.codes())})
+
+
+def make_app(service: TimetableService):
+    service.load()
+    app = web.Application()
+    app.add_routes([
+        web.post(r'/timetable.{format:json|ics}', service.timetable),
+        web.get(r'/timetable.{format:json|ics}', service.timetable),
+        web.get('/health', service.health),
+    ])
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Serve the timetables of students over HTTP",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument(
+        '--fake-erp',
+        default=None, metavar='FILE',
+        help="JSON file with the sections of each ERP user, used instead of ERP")
+    parser.add_argument(
+        '--max-age',
+        type=float, default=60, metavar='MINUTES',
+        help="Reuse the courses fetched from ERP in the last MINUTES minutes")
+    parser.add_argument(
+        '--erp-concurrency',
+        type=int, default=MAX_CONCURRENCY,
+        help="Maximum number of students to fetch from ERP at once")
+    args = parser.parse_args()
+
+    fake_erp = read_json(args.fake_erp) if args.fake_erp else None
+    service = TimetableService(fake_erp, args.max_age * 60, args.erp_concurrency)
+    web.run_app(make_app(service), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+"""Events of every section in the timetable, generated once per semester.
+
+The events of a section are the same for every student registered to it, so
+they are generated for all the sections in CourseDB at once and cached on
+disk, until the timetable or the academic calendar changes. The events of a
+student are then looked up by their sections.
+"""
+import hashlib
+import pickle
+import threading
+from collections import OrderedDict
+
+import dates
+import ics
+from coalesce import coalesce_course
+from events import (EventType, make_compre_event, make_midsem_event,
+                    make_section_events)
+from parse_excel import course_db
+from timetable import find_section, get_course
+from utils import get_cache_path
+
+# bump when the generated events change
+TEMPLATES_VERSION = 4
+EXAMS = (('Midsem', EventType.Midsem), ('Compre', EventType.Compre))
+EXAM_NAMES = {exam for exam, _ in EXAMS}
+MAX_ON_DEMAND = 1024  # sections generated on lookup, kept in an LRU
+
+
+def get_signature():
+    """Hash of the timetable and the academic calendar the events are made from"""
+    calendar = (
+        TEMPLATES_VERSION, dates.today.year, dates.first_workday, dates.last_workday,
+        sorted(dates.holidays), sorted(dates.day_changes.items()),
+        sorted((dates.midsem_dates or {}).items()),
+    )
+    return hashlib.sha256(
+        (course_db.fingerprint() + repr(calendar)).encode()).hexdigest()
+
+
+def make_section(course_code, sec_num):
+    record = course_db[course_code]
+    if not record or not find_section(record.sections, sec_num):
+        return ()  # checked first, since get_course prints about it
+    course = coalesce_course(get_course(course_code, [sec_num]))
+    if not course or not course.sections:
+        return ()
+    return tuple(make_section_events(course, course.sections[0]))
+
+
+def compile_events():
+    """Generate the events of all the sections and exams in the timetable.
+
+    Returns a map of (course code, section or exam name) to its events. The
+    invalid courses are skipped, and are generated again when looked up.
+    """
+    events = {}
+    for course_code in course_db.codes():
+        sections = list(course_db[course_code].sections)
+        try:
+            course = coalesce_course(get_course(course_code, sections))
+        except Exception:
+            continue
+        for sec_num, section in zip(sections, course.sections):
+            events[course_code, sec_num] = tuple(make_section_events(course, section))
+        if course.midsem:
+            events[course_code, 'Midsem'] = (make_midsem_event(course),)
+        if course.compre:
+            events[course_code, 'Compre'] = (make_compre_event(course),)
+    return events
+
+
+def make_fragment(events, dtstamp):
+    """VEVENTs of the events, along with a hash of them"""
+    text = ics.make_fragment(events, dtstamp)
+    return text, hashlib.sha1(text.encode()).hexdigest()
+
+
+class EventTemplates:
+    """Events for the sections of all the courses, shared by all students.
+
+    The events of each section and exam are also kept as an iCalendar
+    fragment with its hash, so the feed of a student is just a concatenation
+    of the fragments, and its ETag a hash of their hashes.
+    """
+
+    def __init__(self, event_types=EventType.All):
+        self.event_types = event_types
+        self.dtstamp = None
+        self._events = None
+        self._fragments = None
+        self._on_demand = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def cache_file(self):
+        return get_cache_path('event-templates', course_db.tt_file.stem + '.pickle')
+
+    def load(self, force=False):
+        """Read the events from the cache, or generate them if it is outdated"""
+        signature = get_signature()
+        with self._lock:
+            self._on_demand.clear()
+        if not force and self.cache_file.exists():
+            with open(self.cache_file, 'rb') as f:
+                try:
+                    cache = pickle.load(f)
+                except (pickle.UnpicklingError, EOFError):
+                    cache = None
+            if isinstance(cache, dict) and cache.get('signature') == signature:
+                self.dtstamp = cache['dtstamp']
+                self._fragments = cache['fragments']
+                self._events = cache['events']
+                return
+        self.dtstamp = ics.get_dtstamp()  # the same for all the fragments
+        events = compile_events()
+        self._fragments = {key: make_fragment(section_events, self.dtstamp)
+                           for key, section_events in events.items()}
+        self._events = events
+        tmp_file = self.cache_file.with_suffix('.tmp')
+        with open(tmp_file, 'wb') as f:
+            pickle.dump({'signature': signature, 'dtstamp': self.dtstamp,
+                         'events': self._events, 'fragments': self._fragments},
+                        f, pickle.HIGHEST_PROTOCOL)
+        tmp_file.replace(self.cache_file)
+
+    def get_keys(self, course_code, sections, event_types=None):
+        """Keys of the sections and exams of the course, in the order of the events"""
+        if self._events is None:
+            with self._lock:
+                if self._events is None:
+                    self.load()
+        event_types = event_types or self.event_types
+        if event_types & EventType.Lectures:
+            for sec_num in sorted(sections):
+                yield course_code, sec_num
+        for exam, event_type in EXAMS:
+            if event_types & event_type:
+                yield course_code, exam
+
+    def get_on_demand(self, key):
+        """(events, fragment) of a section which wasn't compiled.
+
+        Like the tutorials of lecture-only courses, or unknown sections. Only
+        the most recently used of them are cached, since anyone can look up
+        any section.
+        """
+        with self._lock:
+            entry = self._on_demand.get(key)
+            if entry is not None:
+                self._on_demand.move_to_end(key)
+                return entry
+        events = make_section(*key)
+        entry = events, make_fragment(events, self.dtstamp)
+        with self._lock:
+            self._on_demand[key] = entry
+            if len(self._on_demand) > MAX_ON_DEMAND:
+                self._on_demand.popitem(last=False)
+        return entry
+
+    def get_events(self, key):
+        events = self._events.get(key)
+        if events is None:
+            if key[1] in EXAM_NAMES:
+                return ()
+            events, _ = self.get_on_demand(key)
+        return events
+
+    def get_fragment(self, key):
+        fragment = self._fragments.get(key)
+        if fragment is None:
+            if key[1] in EXAM_NAMES:
+                return make_fragment((), self.dtstamp)
+            _, fragment = self.get_on_demand(key)
+        return fragment
+
+    def get(self, course_code, sections, event_types=None):
+        return [event
+                for key in self.get_keys(course_code, sections, event_types)
+                for event in self.get_events(key)]
+
+    def get_fragments(self, course_code, sections, event_types=None):
+        """(VEVENTs, hash) of each section and exam of the course"""
+        fragments = map(self.get_fragment,
+                        self.get_keys(course_code, sections, event_types))
+        return [fragment for fragment in fragments if fragment[0]]
@@ -0,0 +1,28 @@
+"""Run the tests with the sample config, and the caches in a temp dir"""
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+import toml
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+tmp_dir = None
+
+
+def pytest_configure(config):
+    global tmp_dir
+    tmp_dir = Path(tempfile.mkdtemp(prefix='erp-gcal-tests-'))
+    settings = toml.load(ROOT / 'sample_config.toml')
+    settings['CACHE'] = {'dir': str(tmp_dir / 'cache')}
+    with open(tmp_dir / 'config.toml', 'w') as f:
+        toml.dump(settings, f)
+    os.chdir(tmp_dir)  # utils reads config.toml from the working directory
+
+
+def pytest_unconfigure(config):
+    os.chdir(ROOT)
+    shutil.rmtree(tmp_dir, ignore_errors=True)
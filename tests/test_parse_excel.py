@@ -0,0 +1,30 @@
+import json
+
+import pytest
+
+from bench import make_workbook
+from parse_excel import parse_main_tt, parse_main_tt_parallel, split_sheets
+
+
+@pytest.fixture(scope='module')
+def workbook(tmp_path_factory):
+    path = tmp_path_factory.mktemp('excel') / 'timetable.xlsx'
+    num_split = make_workbook(path, 200, rows_per_sheet=37)
+    assert num_split, "No courses split between sheets"
+    return path
+
+
+@pytest.mark.parametrize('workers', [1, 2, 3, 64])
+def test_parallel_parse_matches_serial(workbook, workers):
+    serial = parse_main_tt(workbook)
+    parallel = parse_main_tt_parallel(workbook, workers)
+    assert json.dumps(parallel) == json.dumps(serial)  # in the same order too
+
+
+@pytest.mark.parametrize('num_sheets, num_chunks', [(1, 4), (7, 3), (28, 4), (3, 64)])
+def test_split_sheets(num_sheets, num_chunks):
+    chunks = split_sheets(num_sheets, num_chunks)
+    assert len(chunks) == min(num_sheets, num_chunks)
+    assert [index for start, stop in chunks for index in range(start, stop)] == list(
+        range(num_sheets))
+
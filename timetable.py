@@ -1,13 +1,18 @@
+import argparse
 import bisect
+import json
 import re
+import traceback
+from concurrent.futures import ProcessPoolExecutor
 from datetime import date, time, timedelta as td
 from functools import partial
+from time import perf_counter
 
+from models import Course, Meeting, Section, Timing, iter_wdays
 from parse_excel import course_db
 from utils import combine_dt
 from dates import first_workday
 
-ISO_WDAY = {d: i for i, d in enumerate(('M', 'T', 'W', 'Th', 'F', 'S'), 1)}
 MIDSEM_PAT = re.compile(r'(\d{1,2})\.(\d{1,2})\s*-+\s*(\d{1,2})\.(\d{1,2})\s*(\w{2})')
 
 
@@ -23,24 +28,23 @@ def calc_start_date(wdays):
 
 
 def parse_sched(sched):
-    weekdays = tuple(ISO_WDAY[day] for day in sched['days'])
-    start_time = time(hour=sched['hours'][0] + 7)
-    end_time = time(hour=sched['hours'][-1] + 7, minute=50)
-    start_date = calc_start_date(weekdays)
-    return {
-        'room': sched['room'],
-        'start': combine_dt(start_date, start_time),
-        'end': combine_dt(start_date, end_time),
-        'wdays': weekdays
-    }
-
-
-def parse_section(section):
-    return {
-        'num': section['num'],
-        'instructors': ', '.join(section['instructors']),
-        'sched': tuple(map(parse_sched, section['sched']))
-    }
+    start_time = time(hour=sched.first_hour + 7)
+    end_time = time(hour=sched.last_hour + 7, minute=50)
+    start_date = calc_start_date(tuple(iter_wdays(sched.wdays)))
+    return Meeting(
+        sched.room,
+        sched.wdays,
+        combine_dt(start_date, start_time),
+        combine_dt(start_date, end_time),
+    )
+
+
+def parse_section(section, num):
+    return Section(
+        num,
+        section.instructors,
+        tuple(map(parse_sched, section.sched)),
+    )
 
 
 def parse_date(raw_date):
@@ -55,66 +59,117 @@ def parse_date(raw_date):
 def parse_midsem(midsem):
     if not midsem:
         return
-    midsem_date = parse_date(midsem['date'])
-    match = MIDSEM_PAT.match(midsem['time'])
+    midsem_date = parse_date(midsem.date)
+    match = MIDSEM_PAT.match(midsem.time)
     is_pm = match.group(5) == 'PM' and match.group(1) != '11'
     times = tuple(map(int, match.groups()[:-1]))
     start = time(hour=times[0] + 12 * is_pm, minute=times[1])
     end = time(hour=times[2] + 12 * is_pm, minute=times[3])
-    return {
-        'start': combine_dt(midsem_date, start),
-        'end': combine_dt(midsem_date, end)
-    }
+    return Timing(combine_dt(midsem_date, start), combine_dt(midsem_date, end))
 
 
 def parse_compre(compre):
     if not compre:
         return
-    compre_date = parse_date(compre['date'])
+    compre_date = parse_date(compre.date)
 
     def comb(hour):
         return combine_dt(compre_date, time(hour=hour))
 
-    start = 9 if compre['session'] == 'FN' else 14
-    return {'start': comb(start), 'end': comb(start + 3)}
+    start = 9 if compre.time == 'FN' else 14
+    return Timing(comb(start), comb(start + 3))
 
 
-def get_section(sections, sec_num):
+def find_section(sections, sec_num):
+    """Get the section, falling back to the lecture for lecture-only courses"""
     section = sections.get(sec_num)
+    if not section and all(sec_code[0] == 'L' for sec_code in sections.keys()):
+        section = sections.get('L' + sec_num[1:])
+    return section
+
+
+def get_section(sections, sec_num):
+    section = find_section(sections, sec_num)
     if not section:
-        if all(sec_code[0] == 'L' for sec_code in sections.keys()):
-            section = sections.get('L' + sec_num[1:])
-        if not section:
-            print(f'No section {sec_num} found.')
-            return
-    section['num'] = sec_num
-    return parse_section(section)
+        print(f'No section {sec_num} found.')
+        return
+    return parse_section(section, sec_num)
 
 
 def get_course(course_code, sel_sections):
     course = course_db[course_code]
     if not course:
         return
-    get_sec_data = partial(get_section, course['sections'])
-    return {
-        'code': course_code,
-        'name': course['name'],
-        'sections': tuple(filter(None, map(get_sec_data, sel_sections))),
-        'midsem': parse_midsem(course.get('midsem')),
-        'compre': parse_compre(course.get('compre'))
-    }
-
-
-def validate_db():
-    for course, data in course_db.timetable.items():
-        try:
-            get_course(course, data["sections"])
-        except Exception as e:
-            print(f"Invalid data in '{course}'")
-            print(data)
-            raise e
-    print("The parsed data is (probably) valid!")
+    get_sec_data = partial(get_section, course.sections)
+    return Course(
+        course_code,
+        course.name,
+        tuple(filter(None, map(get_sec_data, sel_sections))),
+        parse_midsem(course.midsem),
+        parse_compre(course.compre),
+    )
+
+
+def validate_course(course_code):
+    """Time the conversion of the course, and catch the error raised by it"""
+    start = perf_counter()
+    error = None
+    try:
+        get_course(course_code, course_db[course_code].sections)
+    except Exception:
+        error = traceback.format_exc()
+    return course_code, perf_counter() - start, error
+
+
+def validate_db(workers=1, num_slowest=5):
+    """Convert all the courses and report all the invalid ones.
+
+    The courses are spread across a pool of `workers` processes. Returns the
+    list of (course code, traceback) of the courses that failed.
+    """
+    codes = list(course_db.codes())
+    start = perf_counter()
+    if workers == 1:
+        results = list(map(validate_course, codes))
+    else:
+        with ProcessPoolExecutor(workers) as executor:
+            results = list(executor.map(validate_course, codes, chunksize=64))
+    elapsed = perf_counter() - start
+
+    failures = [(code, error) for code, _, error in results if error]
+    for code, error in failures:
+        print(f"Invalid data in '{code}'")
+        print(json.dumps(course_db[code].to_dict(), indent=4))
+        print(error)
+    timings = sorted(((duration, code) for code, duration, _ in results), reverse=True)
+    total = sum(duration for duration, _ in timings)
+    print(f"Validated {len(codes)} courses in {elapsed:.2f} s "
+          f"({total / max(len(codes), 1) * 1000:.3f} ms per course).")
+    if timings:
+        print("Slowest courses:")
+    for duration, code in timings[:num_slowest]:
+        print(f"    {code:<12} {duration * 1000:8.3f} ms")
+    if failures:
+        print(f"{len(failures)} invalid courses found.")
+    else:
+        print("The parsed data is (probably) valid!")
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Validate the parsed timetable")
+    parser.add_argument(
+        '-j', '--workers',
+        type=int, default=1,
+        help="Number of processes to validate the courses in (0 for one per CPU)")
+    parser.add_argument(
+        '--slowest',
+        type=int, default=5,
+        help="Number of the slowest courses to show")
+    args = parser.parse_args()
+    if validate_db(args.workers or None, args.slowest):
+        exit(1)
 
 
 if __name__ == '__main__':
-    validate_db()
+    main()
@@ -3,6 +3,7 @@ import re
 from datetime import date, datetime, time, timedelta, tzinfo
 from difflib import SequenceMatcher
 from functools import lru_cache
+from pathlib import Path
 
 import requests
 import toml
@@ -23,6 +24,19 @@ def read_toml(path):
 
 config = read_toml('config.toml')
 
+CACHE_DIR = Path(config.get('CACHE', {}).get('dir', Path.home() / '.cache' / 'erp-gcal'))
+
+# names of the private extended properties used for syncing the events
+SYNC_KEY = 'erpgcalKey'
+SYNC_HASH = 'erpgcalHash'
+
+
+def get_cache_path(*parts):
+    """Get the path of a file inside the cache directory, creating its parents"""
+    path = CACHE_DIR.joinpath(*parts)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    return path
+
 
 def read_json(path):
     try:
@@ -64,6 +78,13 @@ def take(n, iterable):
     return (val for _, val in zip(range(n), iterable))
 
 
+def chunked(iterable, n):
+    """Split the iterable into lists of at most n items"""
+    iterator = iter(iterable)
+    while chunk := list(take(n, iterator)):
+        yield chunk
+
+
 def retry_on_conn_error(func):
     def wrapper(*args, **kwargs):
         for _ in range(5):
@@ -81,6 +102,12 @@ def retry_on_conn_error(func):
     return wrapper
 
 
+def get_sync_tag(event):
+    """Get the (key, fingerprint) pair attached to an event, if any"""
+    props = event.get('extendedProperties', {}).get('private', {})
+    return props.get(SYNC_KEY), props.get(SYNC_HASH)
+
+
 def pprint_json(data):
     print(json.dumps(data, indent=4))
 